@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import zipfile
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import h5py
+import numpy as np
+from neXusReader import NeXusReader
+from ape_heMapper import APE_HE_Mapper
+from jsonOutputter import JsonOutputter
+from batchConverter import BatchConverter
+from ape_heSyntheticGenerator import APE_HE_SyntheticGenerator
+from conversionMetrics import max_rss_bytes
+
+
+class StageTimer:
+    """
+    Accumulates the wall time and the peak traced memory of one stage of the conversion over all the files.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.seconds = 0.
+        self.calls = 0
+        self.peak_bytes = 0
+        self._start = None
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds += time.perf_counter() - self._start
+        self.calls += 1
+        if self.trace_memory:
+            self.peak_bytes = max(self.peak_bytes, tracemalloc.get_traced_memory()[1])
+
+    def result(self, n_bytes):
+        return {
+            "seconds": round(self.seconds, 6),
+            "files_per_second": round(self.calls / self.seconds, 3) if self.seconds > 0 else None,
+            "mb_per_second": round(n_bytes / 1e6 / self.seconds, 3) if self.seconds > 0 else None,
+            "peak_traced_bytes": self.peak_bytes if self.trace_memory else None
+        }
+
+
+def benchmark_stages(plan, file_paths, lazy, compact, trace_memory):
+    """
+    Times NeXusReader, APE_HE_Mapper.output_the_document and JsonOutputter separately for every file.
+    With lazy reading the datasets are read while the document is created, so their cost moves to the mapping stage.
+    """
+    read, map_, serialize = StageTimer(trace_memory), StageTimer(trace_memory), StageTimer(trace_memory)
+    document_bytes = 0
+    selection = plan.read_selection()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        for file_path in file_paths:
+            with NeXusReader(file_path, selection=selection, lazy=lazy) as nxs:
+                with read:
+                    all_metadata, file_type = nxs.get_file_contain()
+                with map_:
+                    myDoku = APE_HE_Mapper(None, all_metadata, plan=plan).output_the_document()
+                with serialize:
+                    json_text = JsonOutputter.dumps(myDoku, compact)
+            document_bytes += len(json_text)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    input_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+    return {
+        "read": read.result(input_bytes),
+        "map": map_.result(input_bytes),
+        "serialize": serialize.result(document_bytes),
+        "document_bytes": document_bytes
+    }
+
+
+def benchmark_zip(plan, zip_path, work_dir, workers, compact):
+    """
+    Times the conversion of a whole zip archive, as done by NexusMapping_cmdline.py.
+    """
+    output_path = os.path.join(work_dir, "benchmark_output.zip")
+    start = time.perf_counter()
+    BatchConverter.convert_zip(plan, zip_path, output_path, workers, compact=compact)
+    seconds = time.perf_counter() - start
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        n_files = len(NeXusReader.list_nxs_members(zip_ref))
+    return {
+        "workers": workers,
+        "seconds": round(seconds, 6),
+        "files_per_second": round(n_files / seconds, 3) if seconds > 0 else None,
+        "mb_per_second": round(os.path.getsize(zip_path) / 1e6 / seconds, 3) if seconds > 0 else None,
+        "output_bytes": os.path.getsize(output_path)
+    }
+
+
+# Modules whose import dominates the start of the command line; none of them should be loaded before a file is read
+heavy_modules = ['numpy', 'h5py', 'pandas']
+
+
+def benchmark_startup(runs):
+    """
+    Times fresh interpreters that start bare, import NexusMapping_cmdline and print its help (median of the runs), and
+    lists the heavy modules loaded by the import alone.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = {
+        "interpreter": [sys.executable, "-c", "pass"],
+        "import": [sys.executable, "-c", "import NexusMapping_cmdline"],
+        "help": [sys.executable, os.path.join(here, "NexusMapping_cmdline.py"), "--help"]
+    }
+    results = {}
+    for name, command in commands.items():
+        seconds = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=here, check=True, stdout=subprocess.DEVNULL)
+            seconds.append(time.perf_counter() - start)
+        results[f"{name}_seconds"] = round(statistics.median(seconds), 6)
+
+    check = f"import sys, NexusMapping_cmdline; print(' '.join(m for m in {heavy_modules!r} if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, "-c", check], cwd=here, check=True, capture_output=True, text=True).stdout.split()
+    if loaded:
+        logging.warning(f"Importing NexusMapping_cmdline loads {', '.join(loaded)}")
+    results["heavy_modules_on_import"] = loaded
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the conversion on synthetic APE-HE NeXus files and write the results as JSON.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("results", type=str, help="Path to the JSON results file.")
+    parser.add_argument("--schema", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ape_he_schema.json"), help="Path to the JSON schema file.")
+    parser.add_argument("--files", type=int, default=20, help="Number of synthetic NeXus files.")
+    parser.add_argument("--points", type=int, default=501, help="Length of the scan arrays.")
+    parser.add_argument("--extra-datasets", type=int, default=0, help="Additional scan arrays per file that the schema does not use.")
+    parser.add_argument("--chunks", type=int, default=None, help="Chunk length of the scan arrays; contiguous when not given.")
+    parser.add_argument("--gas-flux", type=int, default=3, help="Number of gas_flux datasets per file.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="Worker counts to time the zip conversion with.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs; the fastest one is reported.")
+    parser.add_argument("--lazy", action="store_true", help="Read the datasets lazily, as NexusMapping_cmdline.py does.")
+    parser.add_argument("--compact", action="store_true", help="Serialize the documents without indentation and spaces.")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Number of fresh interpreters started to time the start of the command line.")
+    parser.add_argument("--startup-only", action="store_true", help="Only time the start of the command line.")
+    parser.add_argument("--work-dir", type=str, default=None, help="Directory of the synthetic files; a temporary directory, removed afterwards, when not given.")
+    args = parser.parse_args()
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "h5py": h5py.__version__
+        },
+        "startup": benchmark_startup(args.startup_runs)
+    }
+    if args.startup_only:
+        JsonOutputter.save_the_file(results, args.results)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="nexus_benchmark_")
+    try:
+        with open(args.schema, 'r') as f:
+            plan = APE_HE_Mapper.compile_plan(json.load(f))
+
+        generator = APE_HE_SyntheticGenerator(args.points, args.extra_datasets, args.chunks, args.gas_flux)
+        file_paths = generator.write_files(os.path.join(work_dir, "nxs"), args.files)
+        zip_path = os.path.join(work_dir, "synthetic.zip")
+        generator.write_zip(zip_path, args.files)
+
+        # Timed runs without tracing, then one run with tracemalloc for the memory peaks, as tracing slows Python down
+        runs = [benchmark_stages(plan, file_paths, args.lazy, args.compact, False) for _ in range(args.repeat)]
+        stages = {stage: min((run[stage] for run in runs), key=lambda result: result["seconds"]) for stage in ["read", "map", "serialize"]}
+        traced = benchmark_stages(plan, file_paths, args.lazy, args.compact, True)
+        for stage in stages:
+            stages[stage]["peak_traced_bytes"] = traced[stage]["peak_traced_bytes"]
+
+        zip_runs = []
+        for workers in args.workers:
+            runs = [benchmark_zip(plan, zip_path, work_dir, workers, args.compact) for _ in range(args.repeat)]
+            zip_runs.append(min(runs, key=lambda result: result["seconds"]))
+
+        results.update({
+            "parameters": {
+                "files": args.files,
+                "points": args.points,
+                "extra_datasets": args.extra_datasets,
+                "chunks": args.chunks,
+                "gas_flux": args.gas_flux,
+                "repeat": args.repeat,
+                "lazy": args.lazy,
+                "compact": args.compact,
+                "input_bytes": sum(os.path.getsize(file_path) for file_path in file_paths)
+            },
+            "stages": stages,
+            "document_bytes": traced["document_bytes"],
+            "zip": zip_runs,
+            "max_rss_bytes": max_rss_bytes()
+        })
+        JsonOutputter.save_the_file(results, args.results)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import json
+import logging
+import sys
+from metadataCatalogue import MetadataCatalogue
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(
+        description="Query the SQLite metadata catalogue of converted NeXus files, or add converted documents to it.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("catalogue", type=str, help="Path to the SQLite catalogue, created by NexusMapping_cmdline.py --catalogue or by add.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="Add JSON documents or zips of JSON documents converted before.",
+                              formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add.add_argument("outputs", type=str, nargs="+", help="JSON documents or zip files of JSON documents.")
+
+    query = commands.add_parser("query", help="List the runs matching every condition.",
+                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    query.add_argument("--where", type=str, action="append", default=[], metavar="PATH OP VALUE",
+                       help="Condition on a field, e.g. 'entry/sample/start_temperature/value>300' or 'entry/title~*CeM*'. "
+                            "PATH may contain * and ?; OP is one of >=, <=, !=, =, >, < or ~ (glob). May be repeated.")
+    query.add_argument("--gas", type=str, action="append", default=[], metavar="NAME[OP VALUE]",
+                       help="Gas of a gas_flux entry, with a flux above 0 unless a condition is given, e.g. 'He' or 'He>=5'. May be repeated.")
+    query.add_argument("--since", type=str, default=None, help="Earliest start time, compared as ISO 8601 text, e.g. 2024-11-23.")
+    query.add_argument("--until", type=str, default=None, help="Latest start time, compared as ISO 8601 text.")
+    query.add_argument("--show", type=str, action="append", default=[], metavar="PATH", help="Also print the fields matching PATH (may contain * and ?). May be repeated.")
+    query.add_argument("--json", action="store_true", help="Print the runs as JSON instead of tab-separated lines.")
+    query.add_argument("--count", action="store_true", help="Print only the number of matching runs.")
+    args = parser.parse_args()
+
+    try:
+        with MetadataCatalogue(args.catalogue) as catalogue:
+            if args.command == "add":
+                count = sum(catalogue.add_output(output_path) for output_path in args.outputs)
+                logging.info(f"{count} documents have been added to {args.catalogue}")
+                return
+
+            runs = catalogue.query([MetadataCatalogue.parse_condition(condition) for condition in args.where], args.gas,
+                                   args.since, args.until)
+            if args.count:
+                print(len(runs))
+                return
+            for run in runs:
+                if args.show:
+                    run['fields'] = catalogue.fields(run, args.show)
+            if args.json:
+                print(json.dumps(runs, indent=4))
+                return
+            for run in runs:
+                columns = [run['source'], run['document'], run['start_time'] or '', run['title'] or run['error'] or '']
+                columns += [f"{path}={value}" for path, value in run.get('fields', {}).items()]
+                print('\t'.join(columns))
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
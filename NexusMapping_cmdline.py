@@ -2,9 +2,17 @@
 import argparse
 import json
 import logging
-from neXusReader import NeXusReader
+import zipfile
 from ape_heMapper import APE_HE_Mapper
-from jsonOutputter import JsonOutputter
+from batchConverter import BatchConverter
+from directoryConverter import DirectoryConverter
+from tailConverter import TailConverter
+from sidecarWriter import SidecarWriter
+from zipShard import ZipShard
+from metadataCatalogue import MetadataCatalogue
+from conversionCache import ConversionCache
+from conversionMetrics import ConversionMetrics
+import os
 import sys
 
 def main():
@@ -15,10 +23,58 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument("ape_he_schema", type=str, help="Path to the JSON schema file.")
-    parser.add_argument("nexus_file", type=str, help="Path to the NeXus (.nxs) file.")
-    parser.add_argument("document_name", type=str, help="Name of the output JSON file or the zip file.")
+    parser.add_argument("nexus_file", type=str, help="Path to the NeXus (.nxs) file, zip file, or directory of NeXus and zip files.")
+    parser.add_argument("document_name", type=str, help="Name of the output JSON file or the zip file, or the output directory for a directory.")
+    parser.add_argument("--also", type=str, nargs=2, action="append", default=[], metavar=("SCHEMA", "OUTPUT"),
+                        help="Also map the NeXus file or zip archive with another JSON schema into OUTPUT, from the same read. May be repeated.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes converting the files of a zip archive in parallel.")
+    parser.add_argument("--rules", type=str, default=None, help="Path to a JSON file of mapping rules (aliases, families, coercions). Defaults to ape_he_rules.json.")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Directory of a cache of converted documents, reused for NeXus files with the same content, schema and rules.")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Size limit of the cache in MB; the least recently used documents are evicted.")
+    parser.add_argument("--compact", action="store_true", help="Write the JSON documents without indentation and spaces.")
+    parser.add_argument("--compression", choices=["deflated", "stored"], default="deflated", help="Compression of the documents in the output zip file.")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=None, metavar="0-9", help="zlib level of the deflated documents; the zlib default when not given.")
+    parser.add_argument("--profile", action="store_true", help="Record the wall time, HDF5 datasets and bytes read and peak RSS of every stage and file into <document_name>.metrics.json.")
+    parser.add_argument("--profile-hook", type=str, action="append", default=[], metavar="MODULE.FUNCTION", help="Function called with the metrics of every converted file, e.g. to feed a monitoring system. Implies --profile.")
+    parser.add_argument("--watch", type=float, default=None, metavar="SECONDS", help="Keep watching the input directory, converting new and changed files every SECONDS.")
+    parser.add_argument("--manifest", type=str, default=None, help="Manifest of the converted files of a directory. Defaults to <document_name>/.nexus_manifest.json.")
+    parser.add_argument("--tail", type=float, default=None, metavar="SECONDS", help="Follow a NeXus file still being written (HDF5 SWMR), updating the document every SECONDS while it grows.")
+    parser.add_argument("--tail-idle", type=float, default=None, metavar="SECONDS", help="Stop following the file once it has not grown for SECONDS; it is followed until interrupted when not given.")
+    parser.add_argument("--sidecars", action="store_true", help="Write the numeric arrays of plain schema slots to .npy files in <document_name>.arrays/ and put references (path, shape, dtype, sha256) into the documents.")
+    parser.add_argument("--sidecar-min-bytes", type=int, default=64 * 1024, help="Arrays smaller than this stay in the documents with --sidecars.")
+    parser.add_argument("--shard", type=str, default=None, metavar="I/N", help="Convert only shard I of N of a zip archive into a partial zip with an index, to be combined by NexusMerge_cmdline.py.")
+    parser.add_argument("--shard-by", choices=ZipShard.methods, default="hash", help="Partition of the files into shards: by a hash of their names, or by ranges of their sorted names.")
+    parser.add_argument("--catalogue", type=str, default=None, metavar="DB", help="Add the documents to a SQLite metadata catalogue, to be queried with NexusCatalogue_cmdline.py.")
+    parser.add_argument("--full-read", action="store_true", help="Read every dataset of the NeXus file instead of only those the schema can use.")
     args = parser.parse_args()
 
+    # Options that do not apply to the input are rejected before anything is written, rather than ignored
+    is_zip = zipfile.is_zipfile(args.nexus_file)
+    is_dir = os.path.isdir(args.nexus_file)
+    if args.also and (is_dir or args.tail is not None):
+        parser.error("--also applies to a NeXus file or a zip archive")
+    if args.tail is not None and (is_zip or is_dir):
+        parser.error("--tail applies to a single NeXus file")
+    if args.tail_idle is not None and args.tail is None:
+        parser.error("--tail-idle applies to --tail")
+    if (args.watch is not None or args.manifest) and not is_dir:
+        parser.error("--watch and --manifest apply to a directory")
+    if args.sidecars and args.tail is not None:
+        parser.error("--sidecars does not apply to --tail")
+    if args.shard:
+        if not is_zip:
+            parser.error("--shard applies to a zip archive")
+        if args.sidecars:
+            # The references of the sidecars are relative to the partial zip
+            parser.error("--sidecars does not apply to --shard")
+        if args.catalogue:
+            # The nodes would share one SQLite database; the merged zip is added instead
+            parser.error("--catalogue does not apply to --shard, use NexusMerge_cmdline.py --catalogue")
+        try:
+            ZipShard.parse(args.shard, args.shard_by)
+        except ValueError as e:
+            parser.error(str(e))
+
     try:
         # Validate files
         #validate_file_path(args.ape_he_schema, '.json')
@@ -28,36 +84,80 @@ def main():
         with open(args.ape_he_schema, 'r') as f:
             ape_he_schema = json.load(f)
 
-        # Load the NeXus files
-        nxs = NeXusReader(args.nexus_file)
-        all_metadata, file_type = nxs.get_file_contain()
+        metrics = None
+        if args.profile or args.profile_hook:
+            metrics = ConversionMetrics([ConversionMetrics.load_hook(hook_name) for hook_name in args.profile_hook])
+
+        # Compile the schema and the mapping rules once
+        with ConversionMetrics.measure(metrics, 'compile'):
+            plan = APE_HE_Mapper.compile_plan(ape_he_schema, APE_HE_Mapper.load_rules(args.rules))
+        cache = None
+        if args.cache_dir:
+            # Compact and indented documents are cached apart
+            plan_digest = plan.digest() + (':compact' if args.compact else '')
+            cache = ConversionCache(args.cache_dir, plan_digest, args.cache_size * 1024 * 1024)
+        sidecars = None
+        if args.sidecars:
+            sidecars = SidecarWriter(args.sidecar_min_bytes)
+            if cache is not None:
+                # A cached document refers to the sidecars written next to the document it was cached from
+                logging.warning("The cache is not used with --sidecars")
+                cache = None
 
-        # Process the metadata, create the document and save
-        if file_type == "_nxs":
-            if isinstance(all_metadata, str):
-                with open(args.document_name, 'w') as f:
-                    json.dump(all_metadata, f, indent=4)
-                #sys.exit(1)
+        shard = ZipShard.parse(args.shard, args.shard_by) if args.shard else None
+        catalogue = MetadataCatalogue(args.catalogue) if args.catalogue else None
+
+        if args.also:
+            # Several schemas mapped from one read of every file
+            if cache is not None:
+                logging.warning("The cache is not used when mapping with several schemas")
+                cache = None
+            targets = [(plan, args.document_name)]
+            with ConversionMetrics.measure(metrics, 'compile'):
+                for schema_path, output_path in args.also:
+                    with open(schema_path, 'r') as f:
+                        targets.append((APE_HE_Mapper.compile_plan(json.load(f), plan.rules), output_path))
+            if is_zip:
+                compression = zipfile.ZIP_STORED if args.compression == "stored" else zipfile.ZIP_DEFLATED
+                BatchConverter.convert_zip_fan_out(targets, args.nexus_file, args.workers, args.full_read, args.compact,
+                                                   compression, args.compress_level, metrics, sidecars, shard, catalogue)
+            else:
+                BatchConverter.fan_out_file(args.nexus_file, targets, args.full_read, args.compact, metrics, sidecars, catalogue)
+        elif is_zip:
+            # Load, process and save the zipped NeXus files one by one, or in parallel
+            compression = zipfile.ZIP_STORED if args.compression == "stored" else zipfile.ZIP_DEFLATED
+            BatchConverter.convert_zip(plan, args.nexus_file, args.document_name, args.workers, args.full_read, cache, args.compact,
+                                       compression, args.compress_level, metrics, sidecars, shard, catalogue)
+        elif is_dir:
+            # Convert the new and changed files of a directory, once or while watching it
+            compression = zipfile.ZIP_STORED if args.compression == "stored" else zipfile.ZIP_DEFLATED
+            converter = DirectoryConverter(plan, args.nexus_file, args.document_name, args.workers, args.full_read, cache, args.compact,
+                                           compression, args.compress_level, metrics, args.manifest, sidecars, catalogue)
+            if args.watch is not None:
+                converter.watch(args.watch)
             else:
-                mapper = APE_HE_Mapper(ape_he_schema, all_metadata)
-                myDoku = mapper.output_the_document()
-                JsonOutputter.save_the_file(myDoku, args.document_name)
+                converter.run_once()
+        elif args.tail is not None:
+            # Keep the document current while the file is being written
+            TailConverter(plan, args.nexus_file, args.document_name, args.full_read, args.compact, metrics, catalogue).run(args.tail, args.tail_idle)
         else:
-            nxs_file_names = list(all_metadata.keys())
-            file_path_list =  []
-            for file_name in nxs_file_names:
-                all_metadata_fn = all_metadata[file_name]
-                mapper = APE_HE_Mapper(ape_he_schema, all_metadata_fn)
-                myDoku = mapper.output_the_document()
-                JsonOutputter.save_the_file(myDoku, file_name+".json")
-                file_path_list.append(file_name+".json")
+            BatchConverter.convert_file(args.nexus_file, args.document_name, plan, args.full_read, cache, args.compact, metrics,
+                                        sidecars=sidecars, catalogue=catalogue)
+        if catalogue is not None:
+            catalogue.close()
 
-            JsonOutputter.save_to_zip(file_path_list, args.document_name)
+        if metrics is not None:
+            # The report is saved next to the output, e.g. output.metrics.json for output.json or output.zip
+            metrics.save(os.path.splitext(args.document_name)[0] + ".metrics.json")
 
     except Exception as e:
-        #logging.error(f"An error occurred: {e}")
+        logging.error(f"An error occurred: {e}")
+        if os.path.isdir(args.document_name):
+            sys.exit(1)
+        # The output holds the error message instead of the document
         with open(args.document_name, 'w') as f:
-            json.dump({"ErrorMessage": e}, f, indent=4)
+            json.dump({"ErrorMessage": str(e)}, f, indent=4)
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
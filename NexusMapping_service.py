@@ -0,0 +1,209 @@
+import io
+import sys
+import json
+import base64
+import logging
+import argparse
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from neXusReader import NeXusReader
+from ape_heMapper import APE_HE_Mapper
+from jsonSerializer import JsonSerializer
+
+
+class ConversionService:
+    """
+    Converts NeXus files in a long-running process, so that the imports and the compiled schema stay warm between jobs.
+    The documents are returned to the caller instead of being written to disk.
+    A job is a dictionary:
+        {"id": any, "path": "file.nxs" or "files.zip"} or {"id": any, "data": base64 content, "name": "file.nxs"}
+        with an optional "schema": path to another JSON schema, compiled on its first use and kept.
+    The response is {"id": any, "documents": [{"name": file name, "document": metadata document or error message}, ...]},
+    or {"id": any, "error": message} when the job itself fails.
+    """
+    def __init__(self, plan, full_read=False):
+        self.plan = plan
+        self.full_read = full_read
+        self._plans = {}
+
+    @staticmethod
+    def warm_up():
+        """
+        Imports h5py, numpy and the statistics when the service starts; the command line imports them lazily, but here
+        the first job would otherwise pay for them.
+        """
+        import numpy
+        import h5py
+        import streamingStatistics
+
+    def plan_for(self, schema_path=None):
+        """
+        Compiled plan of a schema, compiled once with the rules of the default plan.
+        Inputs: schema_path: path to a JSON schema, the default plan when None (string)
+        Output: plan (MappingPlan)
+        """
+        if schema_path is None:
+            return self.plan
+        plan = self._plans.get(schema_path)
+        if plan is None:
+            with open(schema_path, 'r') as f:
+                plan = APE_HE_Mapper.compile_plan(json.load(f), self.plan.rules)
+            self._plans[schema_path] = plan
+        return plan
+
+    def convert(self, source, plan):
+        """
+        Reads and maps a NeXus file, or every NeXus file of a zip archive.
+        Inputs: source: path, or binary file object holding the file or the archive (string or file)
+                plan: compiled JSON file schema (MappingPlan)
+        Output: documents (list of dictionaries) ## [{"name": file name, "document": metadata document}, ...]
+        """
+        selection = None if self.full_read else plan.read_selection()
+        documents = []
+        with NeXusReader(source, selection=selection, lazy=True) as nxs:
+            for file_name, metadata in nxs.iter_file_contain():
+                if isinstance(metadata, str):
+                    document = metadata
+                else:
+                    document = APE_HE_Mapper(None, metadata, plan=plan).output_the_document()
+                documents.append({'name': file_name, 'document': document})
+        return documents
+
+    @staticmethod
+    def in_memory(data, name):
+        """
+        File object of the content of a posted NeXus file or zip archive, named for the documents.
+        """
+        source = io.BytesIO(data)
+        source.name = name
+        return source
+
+    def handle(self, job):
+        """
+        Runs one job, see the class description.
+        Inputs: job (dictionary)
+        Output: response (dictionary)
+        """
+        response = {'id': job.get('id')}
+        try:
+            plan = self.plan_for(job.get('schema'))
+            if 'path' in job:
+                response['documents'] = self.convert(job['path'], plan)
+            elif 'data' in job:
+                source = self.in_memory(base64.b64decode(job['data']), job.get('name', 'nexus.nxs'))
+                response['documents'] = self.convert(source, plan)
+            else:
+                raise ValueError("The job has neither a 'path' nor base64 'data'")
+        except Exception as e:
+            logging.info(f"Error in job {response['id']}: {e}")
+            response['error'] = f"{e}"
+        return response
+
+    def serve_stdin(self, input_stream=sys.stdin, output_stream=sys.stdout):
+        """
+        Reads one JSON job per line and writes one compact JSON response per line, until the end of the input.
+        """
+        for line in input_stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+                response = self.handle(job) if isinstance(job, dict) else {'id': None, 'error': "A job must be a JSON object"}
+            except ValueError as e:
+                response = {'id': None, 'error': f"Invalid job: {e}"}
+            output_stream.write(JsonSerializer.dumps(response, compact=True) + '\n')
+            output_stream.flush()
+
+    def serve_http(self, host, port):
+        """
+        Serves the jobs over HTTP, one at a time:
+            POST /convert with a JSON job, or with the raw content of a NeXus file or zip archive
+                (query parameters: name, schema)
+            GET /health
+        """
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _send(self, status, response):
+                body = JsonSerializer.dumps(response, compact=True).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if urlparse(self.path).path == '/health':
+                    self._send(200, {'status': 'ok'})
+                else:
+                    self._send(404, {'error': f"Unknown path {self.path}"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != '/convert':
+                    self._send(404, {'error': f"Unknown path {self.path}"})
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    try:
+                        job = json.loads(body)
+                    except ValueError as e:
+                        self._send(400, {'error': f"Invalid job: {e}"})
+                        return
+                    if not isinstance(job, dict):
+                        self._send(400, {'error': "A job must be a JSON object"})
+                        return
+                    response = service.handle(job)
+                else:
+                    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    response = {'id': query.get('id')}
+                    try:
+                        plan = service.plan_for(query.get('schema'))
+                        response['documents'] = service.convert(service.in_memory(body, query.get('name', 'nexus.nxs')), plan)
+                    except Exception as e:
+                        logging.info(f"Error converting the posted file: {e}")
+                        response['error'] = f"{e}"
+                self._send(422 if 'error' in response else 200, response)
+
+            def log_message(self, format, *args):
+                logging.info(f"{self.address_string()} - {format % args}")
+
+        server = HTTPServer((host, port), Handler)
+        logging.info(f"Serving conversions on http://{host}:{server.server_port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def main():
+    # The log goes to stderr, so that stdout only holds the responses
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", stream=sys.stderr)
+
+    parser = argparse.ArgumentParser(
+        description="Convert NeXus files to JSON documents in a long-running process, with jobs read as JSON lines from stdin or posted over HTTP.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("ape_he_schema", type=str, help="Path to the default JSON schema file.")
+    parser.add_argument("--rules", type=str, default=None, help="Path to a JSON file of mapping rules. Defaults to ape_he_rules.json.")
+    parser.add_argument("--http", type=int, default=None, metavar="PORT", help="Serve over HTTP on this port instead of reading jobs from stdin.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address the HTTP server listens on.")
+    parser.add_argument("--full-read", action="store_true", help="Read every dataset of the NeXus files instead of only those the schema can use.")
+    args = parser.parse_args()
+
+    with open(args.ape_he_schema, 'r') as f:
+        plan = APE_HE_Mapper.compile_plan(json.load(f), APE_HE_Mapper.load_rules(args.rules))
+    service = ConversionService(plan, args.full_read)
+    service.warm_up()
+
+    if args.http is not None:
+        service.serve_http(args.host, args.http)
+    else:
+        service.serve_stdin()
+
+if __name__ == "__main__":
+    main()
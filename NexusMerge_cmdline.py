@@ -0,0 +1,35 @@
+import argparse
+import logging
+import zipfile
+import sys
+from zipShard import ZipShard
+from metadataCatalogue import MetadataCatalogue
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(
+        description="Combine the partial zips written with NexusMapping_cmdline.py --shard into one zip of JSON documents.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("zip_name", type=str, help="Name of the combined zip file.")
+    parser.add_argument("shards", type=str, nargs="+", help="Partial zip files of every shard, each with its index <partial zip>.shard.json next to it.")
+    parser.add_argument("--compression", choices=["deflated", "stored"], default="deflated", help="Compression of the documents in the combined zip file.")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=None, metavar="0-9", help="zlib level of the deflated documents; the zlib default when not given.")
+    parser.add_argument("--catalogue", type=str, default=None, metavar="DB", help="Add the documents of the combined zip to a SQLite metadata catalogue.")
+    args = parser.parse_args()
+
+    try:
+        # Every member of the archive must be in exactly one shard, or nothing is written
+        compression = zipfile.ZIP_STORED if args.compression == "stored" else zipfile.ZIP_DEFLATED
+        count = ZipShard.merge(args.shards, args.zip_name, compression, args.compress_level)
+        logging.info(f"{len(args.shards)} shards with {count} documents have been merged into {args.zip_name}")
+        if args.catalogue:
+            with MetadataCatalogue(args.catalogue) as catalogue:
+                catalogue.add_output(args.zip_name)
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
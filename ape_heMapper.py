@@ -1,33 +1,63 @@
-import json
+import os
 import logging
-from metadataProcessor import MetadataProcessor
-from neXusReader import NeXusReader
+from mappingPlan import MappingPlan
+from mappingRules import MappingRules
+from metadataTree import MetadataTree
 
 class APE_HE_Mapper:
-    def __init__(self, mySchema, metadata_dict):
+
+    # Aliases, gas_flux family and coercions of the APE-HE NeXus files
+    rules_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ape_he_rules.json')
+
+    def __init__(self, mySchema, metadata_dict, plan=None):
         self.mySchema = mySchema
         self.metadata_dict = metadata_dict
 
-        self.keys_path_schema = MetadataProcessor.extract_keys_from_myDict(self.mySchema)
+        # A plan compiled once can be shared by all the files of a batch
+        self.plan = plan if plan is not None else APE_HE_Mapper.compile_plan(self.mySchema)
+        self.keys_path_schema = list(self.plan.target_paths)
     
         try:
-            self.metadata = {tuple(key.split('/')): value for key, value in self.metadata_dict.items()}
+            # NeXusReader returns a MetadataTree, already keyed by path tuples; a flat dictionary keyed by '/'-joined
+            # paths is still accepted
+            if isinstance(self.metadata_dict, MetadataTree):
+                self.metadata = self.metadata_dict
+            else:
+                self.metadata = {tuple(key.split('/')): value for key, value in self.metadata_dict.items()}
         except Exception as e:
             logging.error(f"Unexpected error while transforming to tuple the metadata keys path: {e}")
-        
-        self.equivalencies = {
-            ('entry', 'sample', 'transformations', 'phi(x)'): ('entry', 'sample', 'transformations', 'phi'),
-            ('entry', 'sample', 'transformations', 'theta(z)'): ('entry', 'sample', 'transformations', 'theta')
-        }
-    
-    def output_the_document(self):
-            
-            # Process metadata
-            metadata = MetadataProcessor.process_gas_flux(self.metadata)
 
-            myDict_parsed = MetadataProcessor.map_equivalencies(metadata, self.keys_path_schema, self.equivalencies)
+    @staticmethod
+    def load_rules(rules_file=None):
+        """
+        Loads the mapping rules, the APE-HE rules by default.
+        Inputs: rules_file: path to a JSON rules file (string)
+        Output: rules (MappingRules)
+        """
+        return MappingRules.load(rules_file or APE_HE_Mapper.rules_file)
+
+    @staticmethod
+    def compile_plan(mySchema, rules=None):
+        """
+        Compiles the schema with the mapping rules into a reusable mapping plan.
+        Inputs: mySchema: JSON file schema (dictionary)
+                rules: mapping rules, the APE-HE rules when None (MappingRules)
+        Output: plan (MappingPlan)
+        """
+        return MappingPlan(mySchema, rules if rules is not None else APE_HE_Mapper.load_rules())
+
+    @staticmethod
+    def read_selection(mySchema):
+        """
+        Builds the set of NeXus datasets the schema can use, so that NeXusReader skips everything else.
+        Inputs: mySchema: JSON file schema (dictionary)
+        Output: selection (ReadSelection)
+        """
+        return APE_HE_Mapper.compile_plan(mySchema).read_selection()
+
+    def output_the_document(self, metrics=None, sidecars=None):
 
-            # Generate document
-            myDoku = MetadataProcessor.create_metadata_document(self.mySchema, myDict_parsed)
+            # Process the metadata and generate the document from a fresh copy of the schema
+            myDoku = self.plan.create_document(self.metadata, metrics, sidecars)
 
-            return myDoku
\ No newline at end of file
+            return myDoku
@@ -0,0 +1,168 @@
+import io
+import os
+import h5py
+import numpy as np
+import zipfile
+import logging
+
+class APE_HE_SyntheticGenerator:
+    """
+    Writes synthetic NeXus files shaped like the APE-HE files (same groups, names, units and string encoding), to
+    measure the conversion on files and batches of any size.
+    Inputs: n_points: length of the scan arrays (integer)
+            n_extra_datasets: additional scan arrays in entry/data, not used by the schema (integer)
+            chunks: chunk length of the scan arrays, contiguous when None (integer)
+            gas_flux_channels: number of gas_flux<i>_<gas> datasets in entry/sample (integer)
+            seed: seed of the random values (integer)
+    """
+
+    gas_names = ['He', 'O2', 'H2', 'CO', 'Ar', 'Others']
+
+    def __init__(self, n_points=501, n_extra_datasets=0, chunks=None, gas_flux_channels=3, seed=0):
+        self.n_points = n_points
+        self.n_extra_datasets = n_extra_datasets
+        self.chunks = chunks
+        self.gas_flux_channels = gas_flux_channels
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def _text(group, name, value, unit=None):
+        dataset = group.create_dataset(name, data=str(value).encode('utf-8'), dtype=h5py.string_dtype('utf-8'))
+        if unit is not None:
+            dataset.attrs['units'] = unit
+        return dataset
+
+    def _array(self, group, name, data, unit=None):
+        chunks = None
+        if self.chunks is not None and data.shape[0] > 0:
+            chunks = (min(self.chunks, data.shape[0]),) + data.shape[1:]
+        dataset = group.create_dataset(name, data=data, chunks=chunks)
+        if unit is not None:
+            dataset.attrs['units'] = unit
+        return dataset
+
+    @staticmethod
+    def _group(parent, name, nx_class):
+        group = parent.create_group(name)
+        group.attrs['NX_class'] = nx_class
+        return group
+
+    def write_nxs(self, file_path, index=0):
+        """
+        Writes one synthetic NeXus file.
+        Inputs: file_path: path to the NeXus file, or a writable binary file object (string or file)
+                index: number of the file in its batch, used in the identifiers (integer)
+        """
+        n = self.n_points
+        energy = np.linspace(500., 560., n)
+        current = self.rng.normal(1e-9, 1e-10, (n, 1))
+        title = f"synthetic_{index:04d}"
+
+        with h5py.File(file_path, 'w') as f:
+            entry = self._group(f, 'entry', 'NXentry')
+            self._text(entry, 'title ', title)
+            self._text(entry, 'entry_identifier', f"{index:04d}")
+            self._text(entry, 'definition', 'NXxas')
+            self._text(entry, 'technique', 'FAST-SCAN XAS (X-RAY ABSORPTION SPECTROSCOPY)')
+            self._text(entry, 'start_time', '2024-11-23T02:21:03+01:00')
+            self._text(entry, 'end_time', '2024-11-23T02:21:58+01:00')
+            self._text(entry, 'duration', 55, 's')
+            self._text(entry, 'number_of_scans', 1)
+
+            data = self._group(entry, 'data', 'NXdata')
+            data.attrs['signal'] = 'sample_current'
+            data.attrs['axes'] = 'energy'
+            self._text(data, 'mode', 'Total Electron Yield')
+            self._array(data, 'energy', energy, 'eV')
+            self._array(data, 'sample_current', current, 'A')
+            self._array(data, 'incoming_beam', self.rng.normal(1e-8, 1e-9, (n, 1)), 'A')
+            self._array(data, 'reference_current', self.rng.normal(1e-8, 1e-9, (n, 1)), 'A')
+            self._array(data, 'processed_data', current[:, 0] / 1e-8)
+            for i in range(self.n_extra_datasets):
+                self._array(data, f"extra_{i:04d}", self.rng.random(n))
+
+            instrument = self._group(entry, 'instrument', 'NXinstrument')
+            source = self._group(instrument, 'source', 'NXsource')
+            self._text(source, 'current', f"{self.rng.uniform(300, 320):.3f}", 'mA')
+            self._text(source, 'energy', '2.000', 'GeV')
+            self._text(source, 'name', 'Elettra-Sincrotrone Trieste')
+            self._text(source, 'probe', 'X-ray')
+            self._text(source, 'type', 'Synchrotron X-ray source')
+
+            monochromator = self._group(instrument, 'monochromator', 'NXmonochromator')
+            self._array(monochromator, 'energy', energy, 'eV')
+            self._text(monochromator, 'integration_time', 100, 'ms')
+            grating = self._group(monochromator, 'grating', 'NXgrating')
+            self._text(grating, 'mirror', 'B')
+            self._text(grating, 'period', 900, 'lines/mm')
+
+            for name in ['incoming_beam', 'reference_current', 'sample_current']:
+                picoammeter = self._group(instrument, f"{name}_picoammeter", 'NXdetector')
+                self._array(picoammeter, 'data', self.rng.normal(1e-8, 1e-9, (n, 1)), 'A')
+                self._text(picoammeter, 'description', 'AH501B PICOAMMETER')
+                self._text(picoammeter, 'picoammeter_current_range', '2.5')
+
+            mirror = self._group(instrument, 'prefocusing_mirror', 'NXmirror')
+            self._text(mirror, 'description', 'First mirror of the beamline')
+            self._text(mirror, 'incident_angle', '1.5', 'degrees')
+            self._text(mirror, 'pressure', '1.298E-8', 'mbar')
+            self._text(mirror, 'temperature', '-190.4', 'C')
+
+            undulator = self._group(instrument, 'undulator', 'NXinsertion_device')
+            self._text(undulator, 'gap', '42.0', 'mm')
+            self._text(undulator, 'phase', '0.01', 'mm')
+            self._text(undulator, 'type', 'undulator')
+
+            slit = self._group(instrument, 'exit_slit', 'NXslit')
+            self._text(slit, 'gap', 8, 'mm')
+
+            sample = self._group(entry, 'sample', 'NXsample')
+            self._text(sample, 'name', 'UiO67Ce')
+            self._text(sample, 'chemical_formula', 'UiO67Ce')
+            self._text(sample, 'situation', 'AMBIENT PRESSURE CELL')
+            self._text(sample, 'start_temperature', '284.5', 'K')
+            self._text(sample, 'end_temperature', '284.5', 'K')
+            self._text(sample, 'pressure', '5.701E-6', 'mbar')
+            for i in range(self.gas_flux_channels):
+                gas_name = self.gas_names[i % len(self.gas_names)]
+                self._text(sample, f"gas_flux{i + 1}_{gas_name}", f"{self.rng.uniform(0, 10):.3f}")
+
+            transformations = self._group(sample, 'transformations', 'NXtransformations')
+            for name in ['x', 'y', 'z']:
+                self._array(transformations, name, self.rng.uniform(-5, 5, 1), 'mm')
+            self._array(transformations, 'phi(x)', np.array([116.]), 'degrees')
+            self._array(transformations, 'theta(z)', np.array([0.]), 'degrees')
+
+            user = self._group(entry, 'user', 'NXuser')
+            self._text(user, 'name ', 'Synthetic')
+
+    def write_files(self, directory, n_files):
+        """
+        Writes a batch of synthetic NeXus files into a directory.
+        Inputs: directory (string)
+                n_files (integer)
+        Output: paths of the NeXus files (list of strings)
+        """
+        os.makedirs(directory, exist_ok=True)
+        file_paths = []
+        for index in range(n_files):
+            file_path = os.path.join(directory, f"synthetic_{index:04d}.nxs")
+            self.write_nxs(file_path, index)
+            file_paths.append(file_path)
+        logging.info(f"{n_files} synthetic NeXus files have been written to {directory}")
+        return file_paths
+
+    def write_zip(self, zip_path, n_files, compression=zipfile.ZIP_STORED):
+        """
+        Writes a batch of synthetic NeXus files into a zip archive, one member at a time.
+        Inputs: zip_path (string)
+                n_files (integer)
+                compression: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        """
+        with zipfile.ZipFile(zip_path, 'w', compression) as zipf:
+            for index in range(n_files):
+                # h5py needs a seekable file, so each file is built in memory before it is added
+                buffer = io.BytesIO()
+                self.write_nxs(buffer, index)
+                zipf.writestr(f"synthetic_{index:04d}.nxs", buffer.getvalue())
+        logging.info(f"{n_files} synthetic NeXus files have been zipped into {zip_path}")
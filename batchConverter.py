@@ -0,0 +1,481 @@
+import os
+import json
+import zipfile
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from neXusReader import NeXusReader, ReadSelection
+from ape_heMapper import APE_HE_Mapper
+from jsonOutputter import JsonOutputter, ZipStreamWriter
+from conversionCache import ConversionCache
+from conversionMetrics import ConversionMetrics
+from zipShard import ZipShard
+
+# Compiled schema, read options and cache of a worker process, set once by _init_worker instead of being sent with every task
+_worker_state = {}
+
+def _init_worker(plan, full_read, cache, compact, profile, plans=None, sidecars=None):
+    _worker_state['plan'] = plan
+    _worker_state['plans'] = plans
+    _worker_state['sidecars'] = sidecars
+    _worker_state['full_read'] = full_read
+    _worker_state['cache'] = cache
+    _worker_state['compact'] = compact
+    _worker_state['profile'] = profile
+
+
+def _convert_member(zip_path, member_name):
+    # The metrics recorded in the worker are sent back with the document, to be completed by the main process
+    metrics = ConversionMetrics() if _worker_state['profile'] else None
+    json_text = BatchConverter.convert_member(zip_path, member_name, _worker_state['plan'], _worker_state['full_read'], _worker_state['cache'],
+                                              _worker_state['compact'], metrics, _worker_state['sidecars'])
+    return json_text, (metrics.current_file if metrics is not None else None)
+
+
+def _convert_member_fan_out(zip_path, member_name):
+    metrics = ConversionMetrics() if _worker_state['profile'] else None
+    json_texts = BatchConverter.convert_member_fan_out(zip_path, member_name, _worker_state['plans'], _worker_state['full_read'],
+                                                       _worker_state['compact'], metrics, _worker_state['sidecars'])
+    return json_texts, (metrics.current_file if metrics is not None else None)
+
+
+def _convert_file(nexus_path, document_path, content_digest):
+    metrics = ConversionMetrics() if _worker_state['profile'] else None
+    BatchConverter.convert_file(nexus_path, document_path, _worker_state['plan'], _worker_state['full_read'], _worker_state['cache'],
+                                _worker_state['compact'], metrics, content_digest, _worker_state['sidecars'])
+    return document_path, (metrics.current_file if metrics is not None else None)
+
+
+class BatchConverter:
+
+    @staticmethod
+    def document_name(member_name):
+        return BatchConverter.file_name(member_name) + ".json"
+
+    @staticmethod
+    def file_name(member_name):
+        return os.path.basename(os.path.splitext(member_name)[0])
+
+    @staticmethod
+    def convert_file(nexus_path, document_path, plan, full_read=False, cache=None, compact=False, metrics=None, content_digest=None,
+                     sidecars=None, catalogue=None):
+        """
+        Converts one NeXus file into a JSON document on disk; the datasets are read lazily, so the file stays open
+        until the document is created.
+        Inputs: nexus_path: path to the NeXus file (string)
+                document_path: path to the JSON document (string)
+                plan: compiled JSON file schema (MappingPlan)
+                full_read: read every dataset instead of only those the schema can use (boolean)
+                cache: documents of files converted before (ConversionCache)
+                compact: write the document without indentation and spaces (boolean)
+                metrics: records the stages of the conversion (ConversionMetrics)
+                content_digest: digest of the file when it is already known, the cache key (string)
+                sidecars: writes large arrays next to the document instead of into it; the cached documents would refer
+                          to the sidecars of another document, so it is not used with a cache (SidecarWriter)
+                catalogue: index the document is added to (MetadataCatalogue)
+        Output: path of the JSON document (string)
+        """
+        if cache is not None:
+            if metrics is not None:
+                metrics.start_file(BatchConverter.file_name(nexus_path))
+            with ConversionMetrics.measure(metrics, 'cache'):
+                if content_digest is None:
+                    with open(nexus_path, 'rb') as f:
+                        content_digest = ConversionCache.digest_file(f)
+                json_text = cache.get(content_digest)
+            if json_text is not None:
+                logging.info(f"Using the cached document of {nexus_path}")
+                with ConversionMetrics.measure(metrics, 'write'):
+                    JsonOutputter.save_the_text(json_text, document_path)
+                BatchConverter.catalogue_document(catalogue, document_path, os.path.basename(document_path), nexus_path, metrics,
+                                                  json_text=json_text)
+                return document_path
+
+        selection = None if full_read else plan.read_selection()
+        with NeXusReader(nexus_path, selection=selection, lazy=True, metrics=metrics) as nxs:
+            all_metadata, file_type = nxs.get_file_contain()
+
+            # Process the metadata, create the document and save
+            if isinstance(all_metadata, str):
+                JsonOutputter.save_the_file(all_metadata, document_path, compact)
+                myDoku = all_metadata
+            else:
+                mapper = APE_HE_Mapper(None, all_metadata, plan=plan)
+                myDoku = mapper.output_the_document(metrics, sidecars.for_document(document_path) if sidecars is not None else None)
+                if cache is None:
+                    # Serialized straight into the file, so serialization is part of the write stage
+                    with ConversionMetrics.measure(metrics, 'write'):
+                        JsonOutputter.save_the_file(myDoku, document_path, compact)
+                else:
+                    with ConversionMetrics.measure(metrics, 'serialize'):
+                        json_text = JsonOutputter.dumps(myDoku, compact)
+                    with ConversionMetrics.measure(metrics, 'write'):
+                        JsonOutputter.save_the_text(json_text, document_path)
+                    cache.put(content_digest, json_text)
+            BatchConverter.catalogue_document(catalogue, document_path, os.path.basename(document_path), nexus_path, metrics, myDoku)
+        return document_path
+
+    @staticmethod
+    def catalogue_document(catalogue, source, document_name, nexus_path, metrics=None, document=None, json_text=None):
+        """
+        Adds a document to the metadata catalogue, when there is one. A document that cannot be indexed is still written.
+        Inputs: source, document_name: see MetadataCatalogue.add
+                nexus_path: path or zip member name of the NeXus file (string)
+                metrics: records the catalogue stage (ConversionMetrics)
+                document: the document as mapped, or the error message of the reader (dictionary or string)
+                json_text: the document as serialized, when it is not given (string)
+        """
+        if catalogue is None:
+            return
+        try:
+            with ConversionMetrics.measure(metrics, 'catalogue'):
+                if json_text is not None:
+                    document = json.loads(json_text)
+                catalogue.add(source, document_name, document, os.path.basename(nexus_path))
+        except Exception as e:
+            logging.warning(f"Error adding {document_name} to the catalogue: {e}")
+
+    @staticmethod
+    def fan_out_selection(plans, full_read=False):
+        """
+        Datasets to read for several plans at once: the union of their selections.
+        """
+        return None if full_read else ReadSelection.union([plan.read_selection() for plan in plans])
+
+    @staticmethod
+    def fan_out_file(nexus_path, targets, full_read=False, compact=False, metrics=None, sidecars=None, catalogue=None):
+        """
+        Converts one NeXus file into a JSON document for each of several schemas, reading the file once: the datasets
+        of every schema are selected together, and a dataset used by several schemas is read once.
+        Inputs: nexus_path: path to the NeXus file (string)
+                targets: compiled JSON file schemas and the paths of their documents (list of (MappingPlan, string) pairs)
+                full_read, compact, metrics, sidecars, catalogue: see convert_file
+        Output: paths of the JSON documents (list of strings)
+        """
+        plans = [plan for plan, document_path in targets]
+        with NeXusReader(nexus_path, selection=BatchConverter.fan_out_selection(plans, full_read), lazy=True, metrics=metrics) as nxs:
+            all_metadata, file_type = nxs.get_file_contain()
+            for plan, document_path in targets:
+                if isinstance(all_metadata, str):
+                    JsonOutputter.save_the_file(all_metadata, document_path, compact)
+                    BatchConverter.catalogue_document(catalogue, document_path, os.path.basename(document_path), nexus_path, metrics, all_metadata)
+                    continue
+                mapper = APE_HE_Mapper(None, all_metadata, plan=plan)
+                myDoku = mapper.output_the_document(metrics, sidecars.for_document(document_path) if sidecars is not None else None)
+                with ConversionMetrics.measure(metrics, 'write'):
+                    JsonOutputter.save_the_file(myDoku, document_path, compact)
+                BatchConverter.catalogue_document(catalogue, document_path, os.path.basename(document_path), nexus_path, metrics, myDoku)
+        return [document_path for plan, document_path in targets]
+
+    @staticmethod
+    def cached_member(zip_path, member_name, cache):
+        """
+        Looks a zip member up in the cache.
+        Inputs: zip_path: path to the zipped NeXus files (string)
+                member_name: name of the NeXus file in the archive (string)
+                cache: documents of files converted before (ConversionCache)
+        Output: content digest of the member (string) and its cached JSON document, None on a miss (string)
+        """
+        try:
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(member_name) as member_file:
+                content_digest = ConversionCache.digest_file(member_file)
+        except Exception as e:
+            logging.info(f"Error computing the digest of {member_name}: {e}")
+            return None, None
+        json_text = cache.get(content_digest)
+        if json_text is not None:
+            logging.info(f"Using the cached document of {member_name}")
+        return content_digest, json_text
+
+    @staticmethod
+    def map_document(member_name, metadata, plan, cache=None, content_digest=None, compact=False, metrics=None, sidecars=None):
+        """
+        Maps the metadata of one NeXus file, serializes the document and stores it in the cache. Errors are written
+        into the document instead of being raised, so that one bad file does not stop the others.
+        Inputs: member_name: name of the NeXus file in the archive (string)
+                metadata: metadata of the file (dictionary) or error message of the reader (string)
+                plan: compiled JSON file schema (MappingPlan)
+                cache: documents of files converted before (ConversionCache)
+                content_digest: digest of the file, the cache key (string)
+                compact: write the document without indentation and spaces (boolean)
+                metrics: records the stages of the conversion (ConversionMetrics)
+                sidecars: writes the large arrays of the output zip next to it, see convert_zip (SidecarWriter)
+        Output: JSON document (string)
+        """
+        try:
+            if isinstance(metadata, str):
+                return JsonOutputter.dumps(metadata, compact)
+            mapper = APE_HE_Mapper(None, metadata, plan=plan)
+            if sidecars is not None:
+                sidecars = sidecars.for_file(BatchConverter.file_name(member_name))
+            myDoku = mapper.output_the_document(metrics, sidecars)
+            with ConversionMetrics.measure(metrics, 'serialize'):
+                json_text = JsonOutputter.dumps(myDoku, compact)
+            if cache is not None and content_digest is not None:
+                cache.put(content_digest, json_text)
+            return json_text
+        except Exception as e:
+            logging.info(f"Error converting {member_name}: {e}")
+            return JsonOutputter.dumps(f"Error converting {member_name}: {e}", compact)
+
+    @staticmethod
+    def convert_member(zip_path, member_name, plan, full_read=False, cache=None, compact=False, metrics=None, sidecars=None):
+        """
+        Reads and maps one NeXus file of a zip archive, the task of a worker process.
+        Inputs: zip_path: path to the zipped NeXus files (string)
+                member_name: name of the NeXus file in the archive (string)
+                plan: compiled JSON file schema (MappingPlan)
+                full_read: read every dataset instead of only those the schema can use (boolean)
+                cache: documents of files converted before (ConversionCache)
+                compact: write the document without indentation and spaces (boolean)
+                metrics: records the stages of the conversion (ConversionMetrics)
+                sidecars: see map_document (SidecarWriter)
+        Output: JSON document (string)
+        """
+        content_digest = None
+        if cache is not None:
+            if metrics is not None:
+                metrics.start_file(BatchConverter.file_name(member_name))
+            with ConversionMetrics.measure(metrics, 'cache'):
+                content_digest, json_text = BatchConverter.cached_member(zip_path, member_name, cache)
+            if json_text is not None:
+                return json_text
+
+        selection = None if full_read else plan.read_selection()
+        with NeXusReader(zip_path, selection=selection, lazy=True, metrics=metrics) as nxs:
+            for file_name, metadata in nxs.iter_file_contain([member_name]):
+                return BatchConverter.map_document(member_name, metadata, plan, cache, content_digest, compact, metrics, sidecars)
+
+    @staticmethod
+    def convert_members(zip_path, member_names, plan, full_read=False, cache=None, compact=False, metrics=None, sidecars=None):
+        """
+        Reads and maps the NeXus files of a zip archive one after another: each document is handed on before the
+        next file is read, so memory is bounded by the largest single file.
+        Inputs: see convert_member
+        Output: generator of (name of the NeXus file in the archive, JSON document), in the order of member_names
+        """
+        cached = {}
+        content_digests = {}
+        if cache is not None:
+            with ConversionMetrics.measure(metrics, 'cache'):
+                for member_name in member_names:
+                    content_digests[member_name], json_text = BatchConverter.cached_member(zip_path, member_name, cache)
+                    if json_text is not None:
+                        cached[member_name] = json_text
+        pending = [member_name for member_name in member_names if member_name not in cached]
+
+        selection = None if full_read else plan.read_selection()
+        with NeXusReader(zip_path, selection=selection, lazy=True, metrics=metrics) as nxs:
+            documents = nxs.iter_file_contain(pending)
+            for member_name in member_names:
+                if member_name in cached:
+                    if metrics is not None:
+                        metrics.start_file(BatchConverter.file_name(member_name))
+                    yield member_name, cached.pop(member_name)
+                    continue
+                file_name, metadata = next(documents)
+                yield member_name, BatchConverter.map_document(member_name, metadata, plan, cache,
+                                                               content_digests.get(member_name), compact, metrics, sidecars)
+
+    @staticmethod
+    def convert_member_fan_out(zip_path, member_name, plans, full_read=False, compact=False, metrics=None, sidecars=None):
+        """
+        Reads one NeXus file of a zip archive once and maps it with every plan, the task of a worker process.
+        Inputs: see convert_members_fan_out
+        Output: JSON documents, one for each plan (list of strings)
+        """
+        for member_name, json_texts in BatchConverter.convert_members_fan_out(zip_path, [member_name], plans, full_read, compact, metrics, sidecars):
+            return json_texts
+
+    @staticmethod
+    def convert_members_fan_out(zip_path, member_names, plans, full_read=False, compact=False, metrics=None, sidecars=None):
+        """
+        Reads the NeXus files of a zip archive one after another, each once, and maps each file with every plan.
+        Inputs: zip_path: path to the zipped NeXus files (string)
+                member_names: names of the NeXus files in the archive (list of strings)
+                plans: compiled JSON file schemas (list of MappingPlan)
+                full_read, compact, metrics: see convert_member
+                sidecars: sidecar writers of the output zips, in the order of plans (list of SidecarWriter)
+        Output: generator of (name of the NeXus file in the archive, JSON documents in the order of plans)
+        """
+        sidecars = sidecars or [None] * len(plans)
+        with NeXusReader(zip_path, selection=BatchConverter.fan_out_selection(plans, full_read), lazy=True, metrics=metrics) as nxs:
+            for member_name, (file_name, metadata) in zip(member_names, nxs.iter_file_contain(member_names)):
+                yield member_name, [BatchConverter.map_document(member_name, metadata, plan, compact=compact, metrics=metrics, sidecars=plan_sidecars)
+                                    for plan, plan_sidecars in zip(plans, sidecars)]
+
+    @staticmethod
+    def identical_members(zip_ref, members):
+        """
+        Groups the members of a zip archive with identical content. Only members with the same CRC-32 and size in the
+        zip directory are read to compare their SHA-256 digests.
+        Inputs: zip_ref (zipfile.ZipFile)
+                members (list of zipfile.ZipInfo)
+        Output: duplicates: name of a member -> name of the first identical member before it (dictionary)
+        """
+        candidates = {}
+        for member in members:
+            candidates.setdefault((member.CRC, member.file_size), []).append(member)
+
+        duplicates = {}
+        for group in candidates.values():
+            if len(group) < 2:
+                continue
+            first_by_digest = {}
+            for member in group:
+                with zip_ref.open(member) as member_file:
+                    content_digest = ConversionCache.digest_file(member_file)
+                first = first_by_digest.setdefault(content_digest, member.filename)
+                if first != member.filename:
+                    duplicates[member.filename] = first
+        return duplicates
+
+    @staticmethod
+    def iter_documents(zip_path, unique_names, plan, workers=1, full_read=False, cache=None, compact=False, metrics=None, sidecars=None):
+        """
+        Converts the given NeXus files of a zip archive, sequentially or in a process pool.
+        Inputs: see convert_zip
+        Output: generator of (name of the NeXus file in the archive, JSON document), in the order of unique_names
+        """
+        if workers <= 1:
+            yield from BatchConverter.convert_members(zip_path, unique_names, plan, full_read, cache, compact, metrics, sidecars)
+            return
+
+        yield from BatchConverter._iter_pool(_convert_member, zip_path, unique_names, workers, metrics,
+                                             (plan, full_read, cache, compact, metrics is not None, None, sidecars),
+                                             lambda message: JsonOutputter.dumps(message, compact))
+
+    @staticmethod
+    def iter_documents_fan_out(zip_path, unique_names, plans, workers=1, full_read=False, compact=False, metrics=None, sidecars=None):
+        """
+        Converts the given NeXus files of a zip archive with several plans, sequentially or in a process pool.
+        Inputs: see convert_zip_fan_out
+        Output: generator of (name of the NeXus file in the archive, JSON documents in the order of plans)
+        """
+        if workers <= 1:
+            yield from BatchConverter.convert_members_fan_out(zip_path, unique_names, plans, full_read, compact, metrics, sidecars)
+            return
+
+        yield from BatchConverter._iter_pool(_convert_member_fan_out, zip_path, unique_names, workers, metrics,
+                                             (None, full_read, None, compact, metrics is not None, plans, sidecars),
+                                             lambda message: [JsonOutputter.dumps(message, compact)] * len(plans))
+
+    @staticmethod
+    def _iter_pool(task, zip_path, unique_names, workers, metrics, initargs, error_documents):
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+            futures = [executor.submit(task, zip_path, member_name) for member_name in unique_names]
+            for member_name, future in zip(unique_names, futures):
+                try:
+                    documents, record = future.result()
+                except Exception as e:
+                    # The worker process itself failed, e.g. it crashed while reading the file
+                    logging.info(f"Error converting {member_name}: {e}")
+                    documents, record = error_documents(f"Error converting {member_name}: {e}"), None
+                if metrics is not None:
+                    if record is not None:
+                        metrics.resume_file(record)
+                    else:
+                        metrics.start_file(BatchConverter.file_name(member_name))
+                yield member_name, documents
+
+    @staticmethod
+    def convert_zip(plan, zip_path, zip_file_path, workers=1, full_read=False, cache=None, compact=False,
+                    compression=zipfile.ZIP_DEFLATED, compresslevel=None, metrics=None, sidecars=None, shard=None, catalogue=None):
+        """
+        Converts every NeXus file of a zip archive and streams the JSON documents into the output zip as they are
+        produced, in archive order. Identical files are converted once. With more than one worker the files are
+        converted in a process pool.
+        Inputs: plan: compiled JSON file schema (MappingPlan)
+                zip_path: path to the zipped NeXus files (string)
+                zip_file_path: path to the output zip file (string)
+                workers: number of worker processes (integer)
+                full_read: read every dataset instead of only those the schema can use (boolean)
+                cache: documents of files converted before (ConversionCache)
+                compact: write the documents without indentation and spaces (boolean)
+                compression: zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+                compresslevel: zlib compression level 0-9, the default level when None (integer)
+                metrics: records the stages of the conversion of every file (ConversionMetrics)
+                sidecars: writes large arrays to <zip_file_path without .zip>.arrays/<file name>/ instead of into the
+                          documents; not used with a cache, see convert_file (SidecarWriter)
+                shard: converts only the files of this shard into a partial zip, and indexes it for ZipShard.merge (ZipShard)
+                catalogue: index the documents are added to as they are written, under the output zip (MetadataCatalogue)
+        """
+        if sidecars is not None:
+            sidecars = sidecars.for_document(zip_file_path)
+        member_names, duplicates, unique_names, shard_index = BatchConverter._unique_members(zip_path, metrics, shard)
+        documents = BatchConverter.iter_documents(zip_path, unique_names, plan, workers, full_read, cache, compact, metrics, sidecars)
+        BatchConverter._stream_zips(member_names, duplicates, ((member_name, [json_text]) for member_name, json_text in documents),
+                                    [zip_file_path], compression, compresslevel, metrics, catalogue)
+        if shard_index is not None:
+            ZipShard.write_index(zip_file_path, shard_index, plan.digest(), BatchConverter.document_name)
+
+    @staticmethod
+    def convert_zip_fan_out(targets, zip_path, workers=1, full_read=False, compact=False,
+                            compression=zipfile.ZIP_DEFLATED, compresslevel=None, metrics=None, sidecars=None, shard=None, catalogue=None):
+        """
+        Converts every NeXus file of a zip archive with several schemas, into one output zip for each schema. Every
+        file is read once, see fan_out_file.
+        Inputs: targets: compiled JSON file schemas and the paths of their output zip files (list of (MappingPlan, string) pairs)
+                zip_path, workers, full_read, compact, compression, compresslevel, metrics, sidecars, shard, catalogue: see convert_zip
+        """
+        plans = [plan for plan, zip_file_path in targets]
+        if sidecars is not None:
+            sidecars = [sidecars.for_document(zip_file_path) for plan, zip_file_path in targets]
+        member_names, duplicates, unique_names, shard_index = BatchConverter._unique_members(zip_path, metrics, shard)
+        documents = BatchConverter.iter_documents_fan_out(zip_path, unique_names, plans, workers, full_read, compact, metrics, sidecars)
+        BatchConverter._stream_zips(member_names, duplicates, documents, [zip_file_path for plan, zip_file_path in targets],
+                                    compression, compresslevel, metrics, catalogue)
+        if shard_index is not None:
+            # Every output is a partial zip of its own schema, merged separately
+            for plan, zip_file_path in targets:
+                ZipShard.write_index(zip_file_path, shard_index, plan.digest(), BatchConverter.document_name)
+
+    @staticmethod
+    def _unique_members(zip_path, metrics, shard=None):
+        shard_index = None
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref, ConversionMetrics.measure(metrics, 'duplicates'):
+            members = NeXusReader.list_nxs_members(zip_ref)
+            if shard is not None:
+                # Identical files are only recognised within a shard
+                selected = shard.select(members)
+                shard_index = shard.index(members, selected)
+                members = selected
+            duplicates = BatchConverter.identical_members(zip_ref, members)
+        member_names = [member.filename for member in members]
+        unique_names = [member_name for member_name in member_names if member_name not in duplicates]
+        return member_names, duplicates, unique_names, shard_index
+
+    @staticmethod
+    def _stream_zips(member_names, duplicates, documents, zip_file_paths, compression, compresslevel, metrics, catalogue=None):
+        """
+        Writes the documents of every member, in archive order, into the output zips, one zip for each document of a member.
+        Inputs: documents: generator of (member name, JSON documents) for the members that are not duplicates
+        """
+        # Documents of the files that have duplicates, kept until the duplicates are written
+        originals = set(duplicates.values())
+        kept = {}
+
+        with ExitStack() as stack:
+            writers = [stack.enter_context(ZipStreamWriter(zip_file_path, compression, compresslevel)) for zip_file_path in zip_file_paths]
+            for member_name in member_names:
+                if member_name in duplicates:
+                    logging.info(f"{member_name} is identical to {duplicates[member_name]}, reusing its document")
+                    if metrics is not None:
+                        metrics.start_file(BatchConverter.file_name(member_name))
+                    json_texts = kept[duplicates[member_name]]
+                else:
+                    converted_name, json_texts = next(documents)
+                    if converted_name in originals:
+                        kept[converted_name] = json_texts
+                with ConversionMetrics.measure(metrics, 'write'):
+                    for writer, json_text in zip(writers, json_texts):
+                        writer.write(BatchConverter.document_name(member_name), json_text)
+                for zip_file_path, json_text in zip(zip_file_paths, json_texts):
+                    BatchConverter.catalogue_document(catalogue, zip_file_path, BatchConverter.document_name(member_name), member_name,
+                                                      metrics, json_text=json_text)
+                if metrics is not None:
+                    metrics.end_file()
+            # The writer threads finish compressing the queued documents
+            with ConversionMetrics.measure(metrics, 'close'):
+                for writer in writers:
+                    writer.close()
@@ -0,0 +1,131 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+
+class ConversionCache:
+    """
+    On-disk cache of JSON documents, keyed by the content digest of a NeXus file and the digest of the mapping plan
+    (schema and rules). When the cache grows over max_bytes, the least recently used documents are evicted.
+    The size of the cache is counted once when it is opened and then kept up to date by put, so that the directory is
+    only listed again when the cache is full, or once max_bytes / rescan_fraction bytes have been added since the last
+    listing, which bounds what worker processes sharing the cache add without seeing each other's entries.
+    """
+
+    # Bumped whenever the conversion code changes the documents, so that older entries are not reused
+    cache_version = '1'
+    rescan_fraction = 16
+    # Temporary files older than this are left over from interrupted writes
+    stale_temp_seconds = 3600
+
+    def __init__(self, directory, plan_digest, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.plan_digest = plan_digest
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._total_bytes = 0
+        self._added_bytes = 0
+        self._evict()
+
+    @staticmethod
+    def digest_file(file_obj):
+        """
+        SHA-256 digest of the content of a file object, read in blocks.
+        Inputs: file_obj: binary file object, e.g. an open NeXus file or zip member
+        Output: digest (string)
+        """
+        sha = hashlib.sha256()
+        for block in iter(lambda: file_obj.read(1024 * 1024), b''):
+            sha.update(block)
+        return sha.hexdigest()
+
+    def _entry_path(self, content_digest):
+        key = hashlib.sha256(f"{self.cache_version}:{self.plan_digest}:{content_digest}".encode()).hexdigest()
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, content_digest):
+        """
+        Stored JSON document of a NeXus file, or None when it has not been converted with this plan yet.
+        Inputs: content_digest: digest of the NeXus file (string)
+        Output: JSON text (string) or None
+        """
+        entry_path = self._entry_path(content_digest)
+        try:
+            with open(entry_path, 'r') as f:
+                json_text = f.read()
+            # The modification time orders the entries for the LRU eviction
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.info(f"Error reading cache entry {entry_path}: {e}")
+            return None
+        return json_text
+
+    def put(self, content_digest, json_text):
+        """
+        Stores the JSON document of a NeXus file and evicts the least recently used documents if needed.
+        Inputs: content_digest: digest of the NeXus file (string)
+                json_text: JSON document (string)
+        """
+        entry_path = self._entry_path(content_digest)
+        data = json_text.encode('utf-8')
+        temp_path = None
+        try:
+            try:
+                replaced_bytes = os.stat(entry_path).st_size
+            except FileNotFoundError:
+                replaced_bytes = 0
+            # Written under a temporary name and renamed, so that concurrent readers never see a partial entry
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, entry_path)
+        except Exception as e:
+            logging.info(f"Error writing cache entry {entry_path}: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self._total_bytes += len(data) - replaced_bytes
+        self._added_bytes += len(data)
+        if self._total_bytes > self.max_bytes or self._added_bytes > self.max_bytes // self.rescan_fraction:
+            self._evict()
+
+    def _evict(self):
+        """
+        Lists the cache, removes the temporary files left over from interrupted writes and, when the cache is over
+        max_bytes, evicts the least recently used documents.
+        """
+        entries = []
+        total = 0
+        stale_time = time.time() - self.stale_temp_seconds
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.name.endswith('.tmp'):
+                        if entry.stat().st_mtime < stale_time:
+                            os.remove(entry.path)
+                            logging.info(f"Removed the leftover temporary file {entry.path}")
+                        continue
+                    if not entry.name.endswith('.json'):
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total > self.max_bytes:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    logging.info(f"Evicted cache entry {path}")
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self._total_bytes = total
+        self._added_bytes = 0
@@ -0,0 +1,87 @@
+import os
+import json
+import logging
+import tempfile
+
+class ConversionManifest:
+    """
+    Record of the files of a directory that have been converted: relative path -> size, modification time, content
+    digest and document, saved as a JSON file. A file whose size and modification time are unchanged is not read again;
+    a file that was only touched is recognised by its digest. The manifest is reset when the schema, the rules or the
+    output options change, as the documents would then differ.
+    """
+
+    manifest_version = 1
+
+    def __init__(self, file_path, plan_digest):
+        self.file_path = file_path
+        self.plan_digest = plan_digest
+        self.entries = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_path, 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning(f"Error reading the manifest {self.file_path}, every file will be converted: {e}")
+            return
+        if manifest.get('version') != self.manifest_version or manifest.get('plan_digest') != self.plan_digest:
+            logging.info(f"The schema, rules or options changed since {self.file_path} was written, every file will be converted")
+            return
+        self.entries = manifest.get('files', {})
+
+    def save(self):
+        """
+        Writes the manifest under a temporary name and renames it, so that it is never left half written.
+        """
+        manifest = {'version': self.manifest_version, 'plan_digest': self.plan_digest, 'files': self.entries}
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f, indent=4)
+            os.replace(temp_path, self.file_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def unchanged(self, rel_path, stat, document_path):
+        """
+        Whether a file has the size and modification time it had when it was converted, and its document still exists.
+        Inputs: rel_path: path of the file relative to the directory (string)
+                stat: os.stat_result of the file
+                document_path: path of its document (string)
+        Output: boolean
+        """
+        entry = self.entries.get(rel_path)
+        return (entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+                and os.path.exists(document_path))
+
+    def same_content(self, rel_path, content_digest):
+        """
+        Whether a file has the content it had when it was converted.
+        """
+        entry = self.entries.get(rel_path)
+        return entry is not None and entry['digest'] == content_digest
+
+    def record(self, rel_path, stat, content_digest, document):
+        """
+        Records a converted file.
+        Inputs: rel_path: path of the file relative to the directory (string)
+                stat: os.stat_result of the file, taken before it was converted
+                content_digest (string)
+                document: path of its document relative to the output directory (string)
+        """
+        self.entries[rel_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': content_digest, 'document': document}
+
+    def forget_missing(self, rel_paths):
+        """
+        Drops the files that are no longer in the directory, so that they are converted again if they come back.
+        Inputs: rel_paths: files found in the directory (set of strings)
+        """
+        for rel_path in [rel_path for rel_path in self.entries if rel_path not in rel_paths]:
+            del self.entries[rel_path]
@@ -0,0 +1,194 @@
+import sys
+import time
+import logging
+import importlib
+from contextlib import contextmanager, nullcontext
+from jsonOutputter import JsonOutputter
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def max_rss_bytes():
+    """
+    Peak resident memory of the process so far, None where the platform does not report it.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class ConversionMetrics:
+    """
+    Records, for each file and each stage of its conversion, the wall time, the number of HDF5 datasets read and
+    their bytes, and how much the stage raised the peak RSS of the process (ru_maxrss after the stage minus before it).
+    The growth is 0 for a stage that stayed below a peak reached earlier, so the largest stages of a run show where its
+    memory went; a stage nested in another is also counted in the outer stage. The stages are:
+        open: opening a zip member for h5py
+        read: traversing the HDF5 tree (and reading the selected datasets unless they are read lazily)
+        families: grouping the datasets of the family rules, e.g. gas_flux
+        map: filling the schema slots, with the lazy dataset reads
+        serialize: writing the document as JSON text
+        write: saving the document
+        catalogue: adding the document to the metadata catalogue
+        close: finishing the output zips, once the last document has been queued (for the whole run)
+    Stages entered outside a file (e.g. looking files up in the cache) are recorded for the whole run.
+    Hooks are called with the record of every finished file, to feed the same counters to a monitoring system.
+    """
+    def __init__(self, hooks=None):
+        self.files = []
+        self.stages = {}
+        self.hooks = list(hooks or [])
+        self._current = None
+        self._active = None
+        self._start = time.perf_counter()
+
+    @staticmethod
+    def load_hook(hook_name):
+        """
+        Imports a hook given as "module.function".
+        Inputs: hook_name (string)
+        Output: hook (callable)
+        """
+        module_name, function_name = hook_name.rsplit('.', 1)
+        return getattr(importlib.import_module(module_name), function_name)
+
+    def add_hook(self, hook):
+        """
+        Registers a function called with the record of every finished file:
+        {"file": name, "seconds": total, "hdf5_bytes": total, "datasets": total, "stages": {stage: {...}, ...}}
+        """
+        self.hooks.append(hook)
+
+    @staticmethod
+    def _new_stage():
+        return {'seconds': 0., 'hdf5_bytes': 0, 'datasets': 0, 'peak_rss_growth_bytes': None}
+
+    def start_file(self, file_name):
+        """
+        Starts recording the stages of a file; the file recorded before is finished. Nothing changes when the file
+        is already being recorded.
+        """
+        if self._current is not None and self._current['file'] == file_name:
+            return
+        self.end_file()
+        self._current = {'file': file_name, 'stages': {}}
+
+    @property
+    def current_file(self):
+        """
+        Record of the file being recorded, None between files.
+        """
+        return self._current
+
+    def end_file(self):
+        """
+        Finishes the file being recorded, if any, and passes its record to the hooks.
+        """
+        record, self._current = self._current, None
+        if record is None:
+            return
+        stages = record['stages'].values()
+        record['seconds'] = round(sum(stage['seconds'] for stage in stages), 6)
+        record['hdf5_bytes'] = sum(stage['hdf5_bytes'] for stage in stages)
+        record['datasets'] = sum(stage['datasets'] for stage in stages)
+        for stage in stages:
+            stage['seconds'] = round(stage['seconds'], 6)
+        self._add_file(record)
+
+    def _add_file(self, record):
+        self.files.append(record)
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                logging.warning(f"Error in metrics hook {hook}: {e}")
+
+    def resume_file(self, record):
+        """
+        Continues recording a file whose first stages were recorded by another ConversionMetrics, e.g. in a worker process.
+        Inputs: record: file record (dictionary)
+        """
+        self.end_file()
+        self._current = record
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager recording one stage of the current file, or of the run outside a file.
+        """
+        stages = self._current['stages'] if self._current is not None else self.stages
+        record = stages.setdefault(name, self._new_stage())
+        previous, self._active = self._active, record
+        start_rss = max_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] += time.perf_counter() - start
+            if start_rss is not None:
+                record['peak_rss_growth_bytes'] = (record['peak_rss_growth_bytes'] or 0) + max_rss_bytes() - start_rss
+            self._active = previous
+
+    @staticmethod
+    def measure(metrics, name):
+        """
+        Stage of metrics, or a context manager doing nothing when there are no metrics to record.
+        Inputs: metrics (ConversionMetrics or None)
+                name: name of the stage (string)
+        """
+        return metrics.stage(name) if metrics is not None else nullcontext()
+
+    def count_read(self, data):
+        """
+        Counts a dataset (or a part of it) read from HDF5 in the active stage.
+        Inputs: data: value read (numpy array, numpy scalar or bytes)
+        """
+        record = self._active
+        if record is None:
+            stages = self._current['stages'] if self._current is not None else self.stages
+            record = stages.setdefault('other', self._new_stage())
+        record['datasets'] += 1
+        if hasattr(data, 'nbytes'):
+            # numpy arrays and scalars
+            record['hdf5_bytes'] += int(data.nbytes)
+        elif isinstance(data, (bytes, str)):
+            record['hdf5_bytes'] += len(data)
+
+    def report(self):
+        """
+        Metrics of the run: the file records, the stages outside files, totals by stage, and the peak RSS of the process.
+        Output: report (dictionary)
+        """
+        self.end_file()
+        totals = {}
+        for record in self.files:
+            for name, stage in record['stages'].items():
+                total = totals.setdefault(name, {'seconds': 0., 'hdf5_bytes': 0, 'datasets': 0, 'peak_rss_growth_bytes': None})
+                total['seconds'] += stage['seconds']
+                total['hdf5_bytes'] += stage['hdf5_bytes']
+                total['datasets'] += stage['datasets']
+                if stage.get('peak_rss_growth_bytes') is not None:
+                    total['peak_rss_growth_bytes'] = (total['peak_rss_growth_bytes'] or 0) + stage['peak_rss_growth_bytes']
+        for total in totals.values():
+            total['seconds'] = round(total['seconds'], 6)
+        for stage in self.stages.values():
+            stage['seconds'] = round(stage['seconds'], 6)
+        return {
+            'wall_seconds': round(time.perf_counter() - self._start, 6),
+            'max_rss_bytes': max_rss_bytes(),
+            'totals': totals,
+            'run_stages': self.stages,
+            'files': self.files
+        }
+
+    def save(self, file_path):
+        """
+        Saves the report as a JSON file.
+        """
+        JsonOutputter.save_the_file(self.report(), file_path)
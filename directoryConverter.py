@@ -0,0 +1,210 @@
+import os
+import time
+import zipfile
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from batchConverter import BatchConverter, _init_worker, _convert_file
+from conversionCache import ConversionCache
+from conversionManifest import ConversionManifest
+
+class DirectoryConverter:
+    """
+    Converts the NeXus files (.nxs) and zipped NeXus files (.zip) of a directory tree into an output directory with the
+    same layout, once or repeatedly while watching it. A manifest of the converted files makes every run convert only
+    the new and changed files.
+    Inputs: plan: compiled JSON file schema (MappingPlan)
+            input_dir: directory of the NeXus files (string)
+            output_dir: directory of the JSON documents (string)
+            workers: number of worker processes (integer)
+            full_read, cache, compact, compression, compresslevel, metrics, sidecars: see BatchConverter.convert_zip
+            manifest_path: path to the manifest, <output_dir>/.nexus_manifest.json when None (string)
+            catalogue: index the documents are added to, committed after every scan (MetadataCatalogue)
+    """
+
+    # The manifest is saved at most this often (seconds) while the files are converted, and always at the end
+    manifest_save_interval = 5.
+
+    def __init__(self, plan, input_dir, output_dir, workers=1, full_read=False, cache=None, compact=False,
+                 compression=zipfile.ZIP_DEFLATED, compresslevel=None, metrics=None, manifest_path=None, sidecars=None, catalogue=None):
+        self.plan = plan
+        self.input_dir = os.path.abspath(input_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.workers = workers
+        self.full_read = full_read
+        self.cache = cache
+        self.compact = compact
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.metrics = metrics
+        self.sidecars = sidecars
+        self.catalogue = catalogue
+        manifest_path = manifest_path or os.path.join(self.output_dir, '.nexus_manifest.json')
+        # Compact and indented documents, and documents with or without sidecars, are different outputs
+        self.manifest = ConversionManifest(manifest_path, plan.digest() + (':compact' if compact else '')
+                                           + (f':sidecars={sidecars.min_bytes}' if sidecars is not None else ''))
+        self._last_save = time.monotonic()
+
+    def scan(self):
+        """
+        Lists the NeXus files and zip archives of the input directory, leaving out the output directory, hidden files
+        and macOS resource forks.
+        Output: relative path -> os.stat_result (dictionary)
+        """
+        files = {}
+        for root, dirs, names in os.walk(self.input_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != '__MACOSX'
+                             and os.path.join(root, d) != self.output_dir)
+            for name in sorted(names):
+                if name.startswith('.') or not name.endswith(('.nxs', '.zip')):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    files[os.path.relpath(path, self.input_dir).replace(os.sep, '/')] = os.stat(path)
+                except FileNotFoundError:
+                    continue
+        return files
+
+    def document_path(self, rel_path):
+        """
+        Path of the document of a file: a .json for a NeXus file, a .zip for a zip archive.
+        """
+        base, extension = os.path.splitext(rel_path)
+        return os.path.join(self.output_dir, *(base + ('.zip' if extension == '.zip' else '.json')).split('/'))
+
+    def pending(self, files):
+        """
+        Selects the new and changed files. Files with an unchanged size and modification time are skipped without being
+        read; the others are compared by content digest.
+        Inputs: files: relative path -> os.stat_result (dictionary)
+        Output: (relative path, os.stat_result, content digest) of the files to convert (list of tuples)
+        """
+        pending = []
+        for rel_path, stat in files.items():
+            document_path = self.document_path(rel_path)
+            if self.manifest.unchanged(rel_path, stat, document_path):
+                continue
+            try:
+                with open(os.path.join(self.input_dir, rel_path), 'rb') as f:
+                    content_digest = ConversionCache.digest_file(f)
+            except Exception as e:
+                logging.info(f"Error computing the digest of {rel_path}: {e}")
+                continue
+            if self.manifest.same_content(rel_path, content_digest) and os.path.exists(document_path):
+                # Touched but not changed
+                self.manifest.record(rel_path, stat, content_digest, self.manifest.entries[rel_path]['document'])
+                continue
+            pending.append((rel_path, stat, content_digest))
+        return pending
+
+    def _converted(self, rel_path, stat, content_digest):
+        document = os.path.relpath(self.document_path(rel_path), self.output_dir).replace(os.sep, '/')
+        self.manifest.record(rel_path, stat, content_digest, document)
+        if time.monotonic() - self._last_save > self.manifest_save_interval:
+            self.manifest.save()
+            self._last_save = time.monotonic()
+
+    def convert(self, files, found=None):
+        """
+        Converts the new and changed files among the given ones and updates the manifest.
+        Inputs: files: relative path -> os.stat_result of the files that may be converted (dictionary)
+                found: every file in the directory, files when None; the others are dropped from the manifest (set of strings)
+        Output: relative paths of the converted files (list of strings)
+        """
+        self.manifest.forget_missing(set(files) if found is None else found)
+        pending = self.pending(files)
+        nexus_files = [item for item in pending if not item[0].endswith('.zip')]
+        zip_files = [item for item in pending if item[0].endswith('.zip')]
+        converted = []
+
+        for rel_path, stat, content_digest in nexus_files + zip_files:
+            os.makedirs(os.path.dirname(self.document_path(rel_path)), exist_ok=True)
+
+        if self.workers <= 1 or len(nexus_files) <= 1:
+            for rel_path, stat, content_digest in nexus_files:
+                try:
+                    self._convert_nexus_file(rel_path, content_digest)
+                except Exception as e:
+                    logging.info(f"Error converting {rel_path}: {e}")
+                    continue
+                self._converted(rel_path, stat, content_digest)
+                converted.append(rel_path)
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                     initargs=(self.plan, self.full_read, self.cache, self.compact, self.metrics is not None,
+                                               None, self.sidecars)) as executor:
+                futures = {executor.submit(_convert_file, os.path.join(self.input_dir, rel_path), self.document_path(rel_path), content_digest):
+                           (rel_path, stat, content_digest) for rel_path, stat, content_digest in nexus_files}
+                for future in as_completed(futures):
+                    rel_path, stat, content_digest = futures[future]
+                    try:
+                        document_path, record = future.result()
+                    except Exception as e:
+                        # The worker process itself failed; the file is tried again on the next run
+                        logging.info(f"Error converting {rel_path}: {e}")
+                        continue
+                    if self.metrics is not None and record is not None:
+                        self.metrics.resume_file(record)
+                    if self.catalogue is not None:
+                        # The document was mapped in the worker, it is read back to be added
+                        with open(document_path, 'r') as f:
+                            BatchConverter.catalogue_document(self.catalogue, document_path, os.path.basename(document_path), rel_path,
+                                                              self.metrics, json_text=f.read())
+                    if self.metrics is not None and record is not None:
+                        self.metrics.end_file()
+                    self._converted(rel_path, stat, content_digest)
+                    converted.append(rel_path)
+
+        # The files of an archive are spread over the workers by convert_zip itself
+        for rel_path, stat, content_digest in zip_files:
+            try:
+                BatchConverter.convert_zip(self.plan, os.path.join(self.input_dir, rel_path), self.document_path(rel_path), self.workers,
+                                           self.full_read, self.cache, self.compact, self.compression, self.compresslevel, self.metrics,
+                                           self.sidecars, catalogue=self.catalogue)
+            except Exception as e:
+                logging.info(f"Error converting {rel_path}: {e}")
+                continue
+            self._converted(rel_path, stat, content_digest)
+            converted.append(rel_path)
+
+        self.manifest.save()
+        self._last_save = time.monotonic()
+        if self.catalogue is not None:
+            self.catalogue.commit()
+        # A watched directory is scanned often, so scans with nothing to convert are not logged
+        log = logging.info if converted or found is None else logging.debug
+        log(f"{len(converted)} files converted, {len(files) - len(pending)} unchanged")
+        return converted
+
+    def _convert_nexus_file(self, rel_path, content_digest):
+        BatchConverter.convert_file(os.path.join(self.input_dir, rel_path), self.document_path(rel_path), self.plan, self.full_read,
+                                    self.cache, self.compact, self.metrics, content_digest, self.sidecars, self.catalogue)
+        if self.metrics is not None:
+            self.metrics.end_file()
+
+    def run_once(self):
+        """
+        Converts the new and changed files of the directory.
+        Output: relative paths of the converted files (list of strings)
+        """
+        return self.convert(self.scan())
+
+    def watch(self, interval):
+        """
+        Scans the directory every interval seconds and converts the new and changed files, until interrupted.
+        A file is converted once it is no longer being written: its size and modification time are the same in two
+        successive scans, or it was last modified more than one interval ago.
+        Inputs: interval: seconds between two scans (number)
+        """
+        logging.info(f"Watching {self.input_dir} every {interval} s")
+        previous = {}
+        try:
+            while True:
+                files = self.scan()
+                now = time.time()
+                stable = {rel_path: stat for rel_path, stat in files.items()
+                          if previous.get(rel_path) == (stat.st_size, stat.st_mtime_ns) or now - stat.st_mtime > interval}
+                previous = {rel_path: (stat.st_size, stat.st_mtime_ns) for rel_path, stat in files.items()}
+                self.convert(stable, set(files))
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logging.info(f"Stopped watching {self.input_dir}")
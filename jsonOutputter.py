@@ -1,15 +1,40 @@
 import os
-import json
+import queue
 import zipfile
 import logging
+import threading
+from jsonSerializer import JsonSerializer
 
 class JsonOutputter:
 
     @staticmethod
-    def save_the_file(mapped_metadata, file_path):
+    def dumps(mapped_metadata, compact=False):
+        """
+        Serializes a document as it is saved by save_the_file.
+        Inputs: mapped_metadata: metadata document (dictionary)
+                compact: no indentation and no spaces (boolean)
+        Output: JSON text (string)
+        """
+        return JsonSerializer.dumps(mapped_metadata, compact)
+
+    @staticmethod
+    def save_the_file(mapped_metadata, file_path, compact=False):
+        try:
+            with open(file_path, 'w') as json_file:
+                JsonSerializer.dump(mapped_metadata, json_file, compact)
+            logging.info(f"{file_path} has been created successfully!")
+        except Exception as e:
+            #logging.error(f"Failed to save {file_path}: {e}")
+            logging.info(f"Failed to save {file_path}: {e}")
+
+    @staticmethod
+    def save_the_text(json_text, file_path):
+        """
+        Saves a document already serialized by dumps, e.g. one taken from the conversion cache.
+        """
         try:
             with open(file_path, 'w') as json_file:
-                json.dump(mapped_metadata, json_file, indent=4)
+                json_file.write(json_text)
             logging.info(f"{file_path} has been created successfully!")
         except Exception as e:
             #logging.error(f"Failed to save {file_path}: {e}")
@@ -32,3 +57,68 @@ class JsonOutputter:
             #logging.error(f"Failed to save to zip or delete files: {e}")
             logging.info(f"Failed to save to zip or delete files: {e}")
 
+
+class ZipStreamWriter:
+    """
+    Writes JSON documents straight into a zip file as they are produced, without temporary files. The documents are
+    compressed and written by a writer thread, which takes them from a bounded queue in the order they were given, so
+    mapping the next file goes on while the previous document is compressed (zlib releases the GIL).
+    """
+
+    # Documents waiting for the writer thread; write blocks when the queue is full
+    queue_size = 64
+
+    def __init__(self, zip_file_path, compression=zipfile.ZIP_DEFLATED, compresslevel=None):
+        self.zip_file_path = zip_file_path
+        self._zipf = zipfile.ZipFile(zip_file_path, 'w', compression, compresslevel=compresslevel)
+        self._queue = queue.Queue(self.queue_size)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            name, json_text = item
+            try:
+                self._zipf.writestr(name, json_text)
+                logging.info(f"{name} has been added to {self.zip_file_path}")
+            except Exception as e:
+                self._error = e
+
+    def write(self, name, json_text):
+        """
+        Queues a document to be added to the zip file.
+        Inputs: name: name of the document in the archive (string)
+                json_text: JSON document (string)
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((name, json_text))
+
+    def close(self):
+        """
+        Writes the queued documents and the zip directory. Raises the error of the writer thread, if any. Closing
+        again, e.g. when leaving the with block after an explicit close, does nothing.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._zipf.close()
+        if self._error is not None:
+            raise self._error
+        logging.info(f"All files have been zipped into {self.zip_file_path} sucessfully!")
@@ -0,0 +1,119 @@
+import re
+import sys
+import json
+import uuid
+
+
+def _numpy():
+    # numpy values only exist once numpy has been imported, so it is never imported just to serialize a document
+    return sys.modules.get('numpy')
+
+
+class JsonSerializer:
+    """
+    JSON serializer that understands numpy scalars and arrays, built on the json module.
+    The pretty mode produces the same text as json.dump(..., indent=4); the compact mode has no whitespace at all.
+    Compact documents are written by the C encoder of the json module, with numpy values converted by its default hook.
+    Indented documents are written by the json module too, except for numeric arrays of at least array_min_size
+    elements: these are formatted element by element straight from their buffer and spliced into the text, which is
+    faster than the indented encoder of the json module going through ndarray.tolist().
+    """
+
+    # Smallest numeric array formatted from its buffer in the pretty mode
+    array_min_size = 64
+
+    def __init__(self, compact=False):
+        self.compact = compact
+        # Numeric arrays of the pretty mode, replaced by markers until the text is complete
+        self._arrays = []
+        self._marker = f"\x00ndarray:{uuid.uuid4().hex}:"
+
+    @staticmethod
+    def dump(obj, fp, compact=False):
+        """
+        Writes obj as JSON to a text stream.
+        Inputs: obj: document (dictionary, list, string, number, numpy scalar or array, ...)
+                fp: text stream
+                compact: no indentation and no spaces (boolean)
+        """
+        # The json module only uses its C encoder for a complete string, not for a stream
+        fp.write(JsonSerializer.dumps(obj, compact))
+
+    @staticmethod
+    def dumps(obj, compact=False):
+        """
+        Serializes obj as JSON text, see dump.
+        Output: JSON text (string)
+        """
+        serializer = JsonSerializer(compact)
+        if compact:
+            return json.dumps(obj, separators=(',', ':'), default=serializer._default)
+        text = json.dumps(obj, indent=4, default=serializer._default)
+        return serializer._splice(text) if serializer._arrays else text
+
+    def _default(self, obj):
+        """
+        Value the json module writes instead of an object it does not know.
+        """
+        if isinstance(obj, bytes):
+            return obj.decode('utf-8')
+        np = _numpy()
+        if np is not None and isinstance(obj, np.ndarray):
+            if not self.compact and obj.ndim > 0 and obj.size >= self.array_min_size and obj.dtype.kind in 'fiub':
+                self._arrays.append(obj)
+                return f"{self._marker}{len(self._arrays) - 1}"
+            return obj.tolist()
+        if np is not None and isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    def _splice(self, text):
+        """
+        Replaces the markers of the numeric arrays by the arrays, indented like the lines holding the markers.
+        """
+        # The leading NUL of the marker is escaped by the json module
+        pattern = re.compile(re.escape(json.dumps(self._marker)[:-1]) + r'(\d+)"')
+        parts = []
+        start = 0
+        for match in pattern.finditer(text):
+            line = text[text.rfind('\n', 0, match.start()) + 1:match.start()]
+            level = (len(line) - len(line.lstrip(' '))) // 4
+            parts.append(text[start:match.start()])
+            parts.append(JsonSerializer._format_array(self._arrays[int(match.group(1))], level))
+            start = match.end()
+        parts.append(text[start:])
+        return ''.join(parts)
+
+    @staticmethod
+    def _float(value):
+        if value != value:
+            return 'NaN'
+        if value == float('inf'):
+            return 'Infinity'
+        if value == -float('inf'):
+            return '-Infinity'
+        return float.__repr__(float(value))
+
+    @staticmethod
+    def _format_array(obj, level):
+        """
+        Indented text of a numeric array whose opening bracket is at the given indentation level.
+        """
+        if obj.shape[0] == 0:
+            return '[]'
+        inner = '\n' + '    ' * (level + 1)
+        if obj.ndim > 1:
+            # Rows are written as nested lists, like ndarray.tolist() would give
+            rows = (JsonSerializer._format_array(row, level + 1) for row in obj)
+        else:
+            np = _numpy()
+            kind = obj.dtype.kind
+            if kind == 'f' and obj.dtype == np.float64 and np.isfinite(obj).all():
+                rows = map(float.__repr__, obj)
+            elif kind == 'f':
+                rows = map(JsonSerializer._float, obj)
+            elif kind in 'iu':
+                rows = map(str, obj)
+            else:
+                rows = ('true' if el else 'false' for el in obj)
+        return '[' + inner + (',' + inner).join(rows) + '\n' + '    ' * level + ']'
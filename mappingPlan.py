@@ -0,0 +1,110 @@
+import json
+import hashlib
+import logging
+from collections import namedtuple
+from metadataProcessor import MetadataProcessor
+from mappingRules import MappingRules
+from neXusReader import ReadSelection
+from conversionMetrics import ConversionMetrics
+
+# path: where the slot is in the document (tuple)
+# sources: metadata paths that can fill the slot, in the order they are tried (tuple of tuples)
+# kind: how the metadata is placed into the slot, see MetadataProcessor.slot_kind (string)
+# coercion: type, scale and unit applied to the placed value, see MappingRules.coerce (dictionary or None)
+MappingSlot = namedtuple('MappingSlot', ['path', 'sources', 'kind', 'coercion'])
+
+
+class MappingPlan:
+    """
+    A schema compiled once, together with its mapping rules, and reused for every file of a batch. It holds the slots of
+    the schema with their kinds and metadata sources, and a template from which each file gets a fresh document, so the
+    schema itself is never modified.
+    """
+    def __init__(self, mySchema, rules=None):
+        self.rules = rules if rules is not None else MappingRules()
+        slots = []
+        for path in MetadataProcessor.extract_keys_from_myDict(mySchema):
+            found, schema_value = MappingPlan._schema_value(mySchema, path)
+            kind = MetadataProcessor.slot_kind(schema_value, path[-1]) if found else None
+            if kind is not None:
+                slots.append(MappingSlot(path, self.rules.sources(path), kind, self.rules.coercions.get(path)))
+
+        self.slots = tuple(slots)
+        self.target_paths = tuple(slot.path for slot in self.slots)
+        self._template = json.dumps(mySchema)
+        self._selection = None
+
+    @staticmethod
+    def _schema_value(mySchema, path):
+        value = mySchema
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return False, None
+            value = value[key]
+        return True, value
+
+    def read_selection(self):
+        """
+        Datasets of a NeXus file that the plan can use.
+        Output: selection (ReadSelection)
+        """
+        if self._selection is None:
+            sources = [source for slot in self.slots for source in slot.sources]
+            self._selection = ReadSelection(sources, self.rules.name_patterns())
+        return self._selection
+
+    def digest(self):
+        """
+        Digest of the schema and the mapping rules, which identifies the documents the plan produces.
+        Output: digest (string)
+        """
+        rules = json.dumps(self.rules.config, sort_keys=True)
+        return hashlib.sha256(f"{self._template}\n{rules}".encode()).hexdigest()
+
+    def new_document(self):
+        """
+        Fresh copy of the schema, to be filled with the metadata of one file.
+        Output: document (dictionary)
+        """
+        return json.loads(self._template)
+
+    def create_document(self, metadata_dict, metrics=None, sidecars=None):
+        """
+        Fills a fresh document with the metadata of one file in a single pass over the slots, after grouping the
+        datasets of the family rules.
+        Inputs: metadata_dict: metadata keyed by path (MetadataTree or dictionary) ## {('entry', 'title'): value, ...}
+                metrics: records the families and map stages (ConversionMetrics)
+                sidecars: writes the large arrays of plain slots to files and places references instead (SidecarWriter)
+        Output: metadata document (dictionary)
+        """
+        with ConversionMetrics.measure(metrics, 'families'):
+            metadata_dict = self.rules.collect_families(metadata_dict)
+
+        with ConversionMetrics.measure(metrics, 'map'):
+            return self._fill_document(metadata_dict, sidecars)
+
+    def _fill_document(self, metadata_dict, sidecars=None):
+        document = self.new_document()
+        for slot in self.slots:
+            source = next((source for source in slot.sources if source in metadata_dict), None)
+            if source is None:
+                continue
+            meta_value = metadata_dict[source]
+            if isinstance(meta_value, list) and not meta_value:
+                continue
+
+            sche_ref = document
+            for key in slot.path[:-1]:
+                sche_ref = sche_ref[key]
+            if sidecars is not None and slot.kind == 'plain' and sidecars.wants(meta_value, slot.coercion):
+                try:
+                    # The coercion is applied while the array is written
+                    sche_ref[slot.path[-1]] = sidecars.write(slot.path, meta_value, slot.coercion)
+                    continue
+                except Exception as e:
+                    logging.warning(f"Error writing the sidecar of {slot.path}, the array is kept in the document: {e}")
+            filled = MetadataProcessor.fill_slot(slot.kind, sche_ref, slot.path[-1], meta_value, slot.path)
+            if filled and slot.coercion is not None:
+                MappingRules.apply_coercion(slot.kind, sche_ref, slot.path[-1], slot.coercion, slot.path)
+
+        return document
@@ -0,0 +1,163 @@
+import re
+import json
+import fnmatch
+import logging
+from collections import namedtuple
+from metadataTree import MetadataTree
+
+# target: schema path that collects the matching datasets (tuple)
+# pattern: glob matched against dataset names (string)
+# parent: group the datasets must be in, anywhere when None (tuple)
+# label_separator: the label of a dataset is the last part of its name after this separator (string)
+FamilyRule = namedtuple('FamilyRule', ['target', 'pattern', 'parent', 'label_separator', 'regex'])
+
+
+class MappingRules:
+    """
+    Declarative rules that tell where the metadata of a NeXus file goes in the schema:
+        aliases: schema path -> NeXus paths to try first, e.g. "entry/sample/transformations/phi": ["entry/sample/transformations/phi(x)"]
+        families: datasets collected by name into one schema slot, e.g. {"target": "entry/sample/gas_flux", "pattern": "gas_flux*"}
+        coercions: schema path -> type, scale and unit applied to the value placed into the slot,
+                   e.g. "entry/instrument/monochromator/integration_time": {"type": "float", "scale": 0.001, "unit": "s"}
+    The aliases are compiled into a hash index and the family patterns into an index by their literal prefix, so matching a
+    path costs the same however many datasets and rules there are.
+    """
+    def __init__(self, config=None):
+        config = config or {}
+        self.config = config
+
+        self.aliases = {MappingRules._to_path(target): tuple(MappingRules._to_path(source) for source in sources)
+                        for target, sources in config.get('aliases', {}).items()}
+        self.coercions = {MappingRules._to_path(target): coercion for target, coercion in config.get('coercions', {}).items()}
+
+        self.families = []
+        self._family_index = {}
+        for family in config.get('families', []):
+            pattern = family['pattern']
+            rule = FamilyRule(MappingRules._to_path(family['target']), pattern,
+                              MappingRules._to_path(family['parent']) if family.get('parent') else None,
+                              family.get('label_separator', '_'), re.compile(fnmatch.translate(pattern)))
+            self.families.append(rule)
+            self._family_index.setdefault(MappingRules._literal_prefix(pattern), []).append(rule)
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._family_index})
+
+    @staticmethod
+    def load(file_path):
+        """
+        Loads the rules from a JSON file.
+        Inputs: file_path (string)
+        Output: rules (MappingRules)
+        """
+        with open(file_path, 'r') as f:
+            return MappingRules(json.load(f))
+
+    @staticmethod
+    def _to_path(path):
+        return tuple(path.split('/')) if isinstance(path, str) else tuple(path)
+
+    @staticmethod
+    def _literal_prefix(pattern):
+        match = re.search(r'[*?\[]', pattern)
+        return pattern[:match.start()] if match else pattern
+
+    def sources(self, target):
+        """
+        NeXus paths that can fill a schema path, in the order they are tried.
+        Inputs: target: schema path (tuple)
+        Output: sources (tuple of tuples)
+        """
+        aliases = self.aliases.get(target, ())
+        return aliases + (target,) if target not in aliases else aliases
+
+    def match_family(self, path):
+        """
+        Finds the family rule a dataset belongs to, looking only at the rules whose literal prefix starts its name.
+        Inputs: path: NeXus path of the dataset (tuple)
+        Output: rule (FamilyRule) or None
+        """
+        name = path[-1]
+        for length in self._prefix_lengths:
+            for rule in self._family_index.get(name[:length], ()):
+                if (rule.parent is None or rule.parent == path[:-1]) and rule.regex.match(name):
+                    return rule
+        return None
+
+    def name_patterns(self):
+        """
+        Regular expressions of the family patterns, for NeXusReader.
+        Output: patterns (list of strings)
+        """
+        return ['^' + rule.regex.pattern for rule in self.families]
+
+    def collect_families(self, metadata_dict):
+        """
+        Groups the datasets matching a family rule under its target, in one pass over the metadata. The metadata given
+        is not modified, as the metadata of a file may be mapped with several plans.
+            Inputs: metadata_dict (MetadataTree or dictionary)
+            Output: metadata_dict (MetadataTree or dictionary) ### {('entry', 'sample', 'gas_flux'): [(value1, gas_name1), (value2, gas_name2), ...], ...}
+        """
+        collected = {rule.target: [] for rule in self.families}
+        for key, value in metadata_dict.items():
+            rule = self.match_family(key)
+            if rule is not None:
+                collected[rule.target].append((value, key[-1].split(rule.label_separator)[-1]))
+        if isinstance(metadata_dict, MetadataTree):
+            return metadata_dict.with_values(collected)
+        return {**metadata_dict, **collected}
+
+    @staticmethod
+    def coerce(value, coercion):
+        """
+        Converts a value placed into the document as the coercion says.
+        Inputs: value (object)
+                coercion: {"type": "float" | "int" | "str", "scale": number} (dictionary)
+        Output: converted value (object)
+        """
+        import numpy as np
+        target_type = coercion.get('type')
+        scale = coercion.get('scale')
+        if isinstance(value, np.ndarray):
+            if target_type in ['float', 'int'] or scale is not None:
+                value = value.astype(np.float64) * (scale if scale is not None else 1.)
+                return value.astype(np.int64) if target_type == 'int' else value
+            return value.astype(str) if target_type == 'str' else value
+        if target_type == 'float' or (scale is not None and target_type is None):
+            value = float(value)
+        elif target_type == 'int':
+            value = int(float(value))
+        if scale is not None and isinstance(value, (int, float)):
+            value = value * scale
+            value = int(value) if target_type == 'int' else value
+        if target_type == 'str':
+            value = str(value)
+        return value
+
+    @staticmethod
+    def apply_coercion(kind, sche_ref, last_key, coercion, key_path):
+        """
+        Applies a coercion to the value(s) a slot of the given kind received from fill_slot.
+        Inputs: kind: kind of the slot, see MetadataProcessor.slot_kind (string)
+                sche_ref: dictionary holding the slot (dictionary)
+                last_key: name of the slot (string)
+                coercion (dictionary)
+                key_path: path of the slot, for the log messages (tuple)
+        """
+        try:
+            slot = sche_ref[last_key]
+            if kind == 'plain':
+                sche_ref[last_key] = MappingRules.coerce(slot, coercion)
+            elif kind == 'value':
+                slot['value'] = MappingRules.coerce(slot['value'], coercion)
+            elif kind == 'statistics':
+                for key in slot:
+                    if key not in ['count', 'unit']:
+                        slot[key] = MappingRules.coerce(slot[key], coercion)
+            elif kind == 'gas_flux':
+                for el in slot:
+                    el['value'] = MappingRules.coerce(el['value'], coercion)
+                    if 'unit' in coercion:
+                        el['unit'] = coercion['unit']
+            if 'unit' in coercion and kind in ['value', 'statistics']:
+                slot['unit'] = coercion['unit']
+        except Exception as e:
+            logging.warning(f"Error coercing {key_path}: {e}")
@@ -0,0 +1,248 @@
+import os
+import re
+import json
+import math
+import sqlite3
+import zipfile
+
+class MetadataCatalogue:
+    """
+    SQLite index of the converted documents, so that runs can be selected by their metadata without opening the
+    documents again. Every document is one run; its scalar fields (with the unit of their slot), its gas_flux entries
+    and its title and start and end times are stored, while arrays are left out. Slots the mapping did not fill (the
+    schema placeholders "" and -9999) are not stored either.
+    A run is identified by its output (the document, or the zip holding it) and the document name, so converting or
+    adding a document again replaces its run.
+        runs: id, source, document, nexus, title, start_time, end_time, error
+        fields: run_id, path ('entry/sample/start_temperature/value'), number, text, unit
+        gas_flux: run_id, path, gas_name, value, unit
+    Inputs: db_path: path to the SQLite database, created when missing (string)
+    """
+
+    # Values of the schema slots that the mapping did not fill
+    placeholders = ("", -9999)
+    # Fields also stored in the runs table, the first of each found in the document
+    run_fields = ('title', 'start_time', 'end_time')
+    operators = ('>=', '<=', '!=', '=', '>', '<', '~')
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, source TEXT NOT NULL, document TEXT NOT NULL, nexus TEXT,
+                                         title TEXT, start_time TEXT, end_time TEXT, error TEXT, UNIQUE (source, document));
+        CREATE TABLE IF NOT EXISTS fields (run_id INTEGER NOT NULL, path TEXT NOT NULL, number REAL, text TEXT, unit TEXT);
+        CREATE TABLE IF NOT EXISTS gas_flux (run_id INTEGER NOT NULL, path TEXT NOT NULL, gas_name TEXT, value REAL, unit TEXT);
+        CREATE INDEX IF NOT EXISTS fields_number ON fields (path, number);
+        CREATE INDEX IF NOT EXISTS fields_text ON fields (path, text);
+        CREATE INDEX IF NOT EXISTS fields_run ON fields (run_id);
+        CREATE INDEX IF NOT EXISTS gas_flux_name ON gas_flux (gas_name, value);
+        CREATE INDEX IF NOT EXISTS gas_flux_run ON gas_flux (run_id);
+        CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._connection = sqlite3.connect(db_path)
+        self._connection.executescript(self._schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        """
+        Commits the runs added since the last commit and closes the database.
+        """
+        if self._connection is not None:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def _number(value):
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, (int, float)):
+            return value if not (isinstance(value, float) and math.isnan(value)) else None
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        return number if math.isfinite(number) else None
+
+    @staticmethod
+    def _scalar(value):
+        # A document that has not been serialized yet holds numpy values; arrays are left out
+        if getattr(value, 'ndim', 0) > 0:
+            return None
+        if hasattr(value, 'item'):
+            value = value.item()
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        return value if isinstance(value, (str, int, float)) else None
+
+    @staticmethod
+    def entries(document):
+        """
+        Scalar fields and gas_flux entries of a document.
+        Inputs: document: as created by the mapping or loaded from JSON (dictionary)
+        Output: fields: (path, number, text, unit) (list of tuples)
+                gas_flux: (path, gas_name, value, unit) (list of tuples)
+        """
+        fields = []
+        gas_flux = []
+        # Groups are visited depth first, without recursion
+        stack = [('', document)]
+        while stack:
+            prefix, node = stack.pop()
+            unit = node.get('unit') if isinstance(node.get('unit'), str) else None
+            children = []
+            for key, value in node.items():
+                path = f"{prefix}/{key}" if prefix else key
+                if isinstance(value, dict):
+                    # Arrays written to sidecars are left out as the arrays themselves
+                    if 'sidecar' not in value:
+                        children.append((path, value))
+                elif isinstance(value, (list, tuple)):
+                    # Only the entries of gas_flux slots; arrays are left out
+                    for el in value:
+                        gas_name = MetadataCatalogue._scalar(el.get('gas_name')) if isinstance(el, dict) else None
+                        if gas_name is None or gas_name in MetadataCatalogue.placeholders:
+                            continue
+                        flux = MetadataCatalogue._scalar(el.get('value'))
+                        flux = MetadataCatalogue._number(flux) if flux not in MetadataCatalogue.placeholders else None
+                        gas_flux.append((path, gas_name, flux, el.get('unit')))
+                elif key == 'unit' and unit is not None:
+                    continue
+                else:
+                    value = MetadataCatalogue._scalar(value)
+                    if value is not None and value not in MetadataCatalogue.placeholders:
+                        fields.append((path, MetadataCatalogue._number(value), value if isinstance(value, str) else None, unit))
+            stack.extend(reversed(children))
+        return fields, gas_flux
+
+    def add(self, source, document_name, document, nexus_name=None):
+        """
+        Adds the run of a document, replacing the run of a previous conversion into the same output.
+        Inputs: source: path to the document, or to the zip holding it (string)
+                document_name: name of the document in the zip, or of the document file (string)
+                document: JSON document, or the error message of a file that could not be converted (dictionary or string)
+                nexus_name: name of the NeXus file it was converted from (string)
+        """
+        source = os.path.abspath(source)
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT id FROM runs WHERE source = ? AND document = ?", (source, document_name))
+        row = cursor.fetchone()
+        if row is not None:
+            for table in ['fields', 'gas_flux']:
+                cursor.execute(f"DELETE FROM {table} WHERE run_id = ?", row)
+            cursor.execute("DELETE FROM runs WHERE id = ?", row)
+
+        if not isinstance(document, dict):
+            # The error message of a file that could not be converted
+            cursor.execute("INSERT INTO runs (source, document, nexus, error) VALUES (?, ?, ?, ?)",
+                           (source, document_name, nexus_name, str(document)))
+            return
+        fields, gas_flux = MetadataCatalogue.entries(document)
+        run_values = {}
+        for path, number, text, unit in fields:
+            name = path.rsplit('/', 1)[-1]
+            if name in self.run_fields and text is not None:
+                run_values.setdefault(name, text)
+        cursor.execute("INSERT INTO runs (source, document, nexus, title, start_time, end_time) VALUES (?, ?, ?, ?, ?, ?)",
+                       (source, document_name, nexus_name) + tuple(run_values.get(name) for name in self.run_fields))
+        run_id = cursor.lastrowid
+        cursor.executemany("INSERT INTO fields VALUES (?, ?, ?, ?, ?)",
+                           [(run_id,) + entry for entry in fields])
+        cursor.executemany("INSERT INTO gas_flux VALUES (?, ?, ?, ?, ?)", [(run_id,) + entry for entry in gas_flux])
+
+    def add_output(self, output_path):
+        """
+        Adds the runs of an output written before: a JSON document, or a zip of JSON documents.
+        Inputs: output_path (string)
+        Output: number of runs added (integer)
+        """
+        if zipfile.is_zipfile(output_path):
+            count = 0
+            with zipfile.ZipFile(output_path, 'r') as zip_ref:
+                for member in zip_ref.infolist():
+                    if member.filename.endswith('.json'):
+                        self.add(output_path, member.filename, json.loads(zip_ref.read(member)))
+                        count += 1
+            return count
+        with open(output_path, 'r') as f:
+            self.add(output_path, os.path.basename(output_path), json.load(f))
+        return 1
+
+    @staticmethod
+    def parse_condition(condition):
+        """
+        Reads a condition 'PATH OP VALUE', e.g. 'entry/sample/start_temperature/value>300' or 'entry/title~*CeM*'.
+        PATH may contain the wildcards * and ?; OP is one of >=, <=, !=, =, >, < or ~ (VALUE is then a glob pattern).
+        Inputs: condition (string)
+        Output: (path, operator, value) (tuple)
+        """
+        match = re.match(r'^\s*(.+?)\s*(>=|<=|!=|=|>|<|~)\s*(.*?)\s*$', condition)
+        if match is None:
+            raise ValueError(f"Invalid condition {condition}, expected PATH OP VALUE with OP one of {' '.join(MetadataCatalogue.operators)}")
+        return match.groups()
+
+    @staticmethod
+    def _compare(column_number, column_text, operator, value):
+        if operator == '~':
+            return f"{column_text} GLOB ?", value
+        number = MetadataCatalogue._number(value)
+        if number is not None:
+            return f"{column_number} {operator} ?", number
+        return f"{column_text} {operator} ?", value
+
+    def query(self, conditions=(), gases=(), since=None, until=None):
+        """
+        Runs matching all the given conditions.
+        Inputs: conditions: on the fields, see parse_condition (list of (path, operator, value))
+                gases: gas_flux entries, as a gas name alone (flux above 0) or 'NAME OP VALUE' (list of strings)
+                since, until: bounds of the start time, compared as ISO 8601 text, e.g. '2024-11-23' (string)
+        Output: runs (list of dictionaries)
+        """
+        clauses = []
+        parameters = []
+        for path, operator, value in conditions:
+            comparison, parameter = MetadataCatalogue._compare('number', 'COALESCE(text, CAST(number AS TEXT))', operator, value)
+            clauses.append(f"id IN (SELECT run_id FROM fields WHERE path GLOB ? AND {comparison})")
+            parameters += [path, parameter]
+        for gas in gases:
+            name, operator, value = MetadataCatalogue.parse_condition(gas) if any(op in gas for op in self.operators) else (gas, '>', '0')
+            comparison, parameter = MetadataCatalogue._compare('value', 'CAST(value AS TEXT)', operator, value)
+            clauses.append(f"id IN (SELECT run_id FROM gas_flux WHERE gas_name GLOB ? AND {comparison})")
+            parameters += [name, parameter]
+        if since is not None:
+            clauses.append("start_time >= ?")
+            parameters.append(since)
+        if until is not None:
+            clauses.append("start_time <= ?")
+            parameters.append(until)
+
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        cursor = self._connection.execute(
+            f"SELECT source, document, nexus, title, start_time, end_time, error FROM runs{where} ORDER BY start_time, source, document",
+            parameters)
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def fields(self, run, patterns):
+        """
+        Values of the fields of a run whose paths match the given patterns.
+        Inputs: run: see query (dictionary)
+                patterns: glob patterns of field paths (list of strings)
+        Output: path -> value (dictionary)
+        """
+        values = {}
+        for pattern in patterns:
+            cursor = self._connection.execute(
+                "SELECT path, COALESCE(text, number) FROM fields JOIN runs ON runs.id = fields.run_id "
+                "WHERE runs.source = ? AND runs.document = ? AND path GLOB ?", (run['source'], run['document'], pattern))
+            values.update(cursor.fetchall())
+        return values
@@ -1,12 +1,35 @@
 import re
-import numpy as np
 import logging
 from pathlib import Path
+from neXusReader import LazyDataset
 
 class MetadataProcessor:
 
     avoidFields = ['value', 'unit', 'min_value', 'max_value', 'average_value']
 
+    # Statistics that can be requested in a schema slot, besides 'percentile_<q>' (e.g. 'percentile_50')
+    statisticFields = ['min_value', 'max_value', 'average_value', 'mean_value', 'std_value', 'count']
+    percentilePrefix = 'percentile_'
+
+    @staticmethod
+    def _is_avoid_field(key, slot=None):
+        # The other statistics are fields only in a statistics slot; elsewhere they are ordinary schema keys
+        return key in MetadataProcessor.avoidFields or (MetadataProcessor._is_statistics_slot(slot) and MetadataProcessor._is_statistic(key))
+
+    @staticmethod
+    def _is_statistic(key):
+        return key in MetadataProcessor.statisticFields or (isinstance(key, str) and key.startswith(MetadataProcessor.percentilePrefix))
+
+    @staticmethod
+    def _is_statistics_slot(schema_value):
+        # A slot with min_value, max_value or average_value, or one asking only for statistics (and its unit)
+        if not isinstance(schema_value, dict) or not schema_value:
+            return False
+        if any(key in schema_value for key in ['min_value', 'max_value', 'average_value']):
+            return True
+        return any(MetadataProcessor._is_statistic(key) for key in schema_value) and \
+            all(MetadataProcessor._is_statistic(key) or key == 'unit' for key in schema_value)
+
     @staticmethod
     def extract_keys_from_myDict(myDict, parent_key=None): 
         """
@@ -16,13 +39,12 @@ class MetadataProcessor:
         Output: keys_path (list) ## [('entry', 'title'), ...]
         """
         keys_list = []
-        keys_path = []
 
         for key, value in myDict.items():
             new_key = [key] if parent_key is None else parent_key + [key]
             if isinstance(value, dict):
                 for el in MetadataProcessor.extract_keys_from_myDict(value, new_key):
-                    if el[-1] not in MetadataProcessor.avoidFields:
+                    if not MetadataProcessor._is_avoid_field(el[-1], value if len(el) == len(new_key) + 1 else None):
                         keys_list.append(el)
                     else:
                         keys_list.append(el[:-1])
@@ -31,7 +53,7 @@ class MetadataProcessor:
                 for i, item in enumerate(value):
                     if isinstance(item, dict):
                         for el in MetadataProcessor.extract_keys_from_myDict(item, new_key):
-                            if el[-1] not in MetadataProcessor.avoidFields:
+                            if not MetadataProcessor._is_avoid_field(el[-1], item if len(el) == len(new_key) + 1 else None):
                                 keys_list.append(el)
                             else:
                                 keys_list.append(el[:-1])
@@ -41,13 +63,12 @@ class MetadataProcessor:
             else:
                 keys_list.append(new_key)
 
-            keys_tuple = [tuple(item) for item in keys_list]
-            for item in keys_tuple:
-                if item not in keys_path:
-                    keys_path.append(item)
+        # Removes the duplicates and keeps the first occurrence of each path
+        keys_path = list(dict.fromkeys(tuple(item) for item in keys_list))
         return keys_path
 
 
+    # The dictionary mapping used before MappingPlan and MappingRules, kept for API compatibility; the converters do not call it
     @staticmethod
     def set_nested_value(d, key_path, value):
         """
@@ -93,11 +114,10 @@ class MetadataProcessor:
             Output: mapped_metadata_dict (nested dictionary)
         """
         mapped_metadata_dict = {}
-        keys_metadata = list(metadata_dict.keys())
 
         for key in keys_path_schema:
             matched_key = equivalencies.get(key, key)
-            if matched_key in keys_metadata and matched_key in metadata_dict:
+            if matched_key in metadata_dict:
                 value = metadata_dict[matched_key]
                 MetadataProcessor.set_nested_value(mapped_metadata_dict, key, value)
 
@@ -135,46 +155,149 @@ class MetadataProcessor:
         return mySchema_dict
         
 
+    @staticmethod
+    def _numpy():
+        # Imported on first use, so that starting the command line does not pay for numpy
+        import numpy
+        return numpy
+
+    @staticmethod
+    def _materialize(value):
+        """
+        Reads a LazyDataset handle at the moment its value is placed into the document; other values are returned as they are.
+        """
+        if isinstance(value, LazyDataset):
+            return value.read()
+        return value
+
+    @staticmethod
+    def slot_kind(schema_value, last_key):
+        """
+        Classifies a schema slot by the way metadata is placed into it.
+        Inputs: schema_value: value of the slot in the schema (object)
+                last_key: name of the slot (string)
+        Output: kind: 'plain', 'value', 'statistics', 'gas_flux', or None when the slot is kept as it is (string)
+        """
+        if schema_value in ["", -9999]:
+            return 'plain'
+        if isinstance(schema_value, dict) and 'value' in schema_value:
+            return 'value'
+        if MetadataProcessor._is_statistics_slot(schema_value):
+            return 'statistics'
+        if last_key == 'gas_flux':
+            return 'gas_flux'
+        return None
+
+    @staticmethod
+    def fill_slot(kind, sche_ref, last_key, meta_value, key_path):
+        """
+        Places a metadata value into a schema slot of the given kind.
+        Inputs: kind: kind of the slot, see slot_kind (string)
+                sche_ref: dictionary holding the slot (dictionary)
+                last_key: name of the slot (string)
+                meta_value: metadata value, possibly a LazyDataset (object)
+                key_path: path of the slot, for the log messages (tuple)
+        Output: True when the slot received the value (boolean)
+        """
+        try:
+            if kind == 'plain':
+                sche_ref[last_key] = MetadataProcessor._materialize(meta_value)
+                return True
+            elif kind == 'value':
+                if isinstance(meta_value, LazyDataset) and meta_value.ndim > 0:
+                    # Only the last element is used, read it alone instead of the whole array
+                    sche_ref[last_key]['value'] = meta_value.last()
+                    return True
+                meta_value = MetadataProcessor._materialize(meta_value)
+                if isinstance(meta_value, float):
+                    sche_ref[last_key]['value'] = meta_value
+                    return True
+                elif isinstance(meta_value, str):
+                    sche_ref[last_key]['value'] = float(meta_value)
+                    return True
+                elif isinstance(meta_value, MetadataProcessor._numpy().ndarray):
+                    sche_ref[last_key]['value'] = meta_value[-1]
+                    return True
+                else:
+                    logging.warning(f"Unsupported type for 'value' key in {key_path}: {type(meta_value)}")
+            elif kind == 'statistics' and meta_value.size > 0:
+                try:
+                    MetadataProcessor._apply_arithmetic(sche_ref, last_key, meta_value)
+                    return True
+                except Exception as e:
+                    logging.warning(f"Error computing min or max for {key_path}: {e}")
+            elif kind == 'gas_flux':
+                try:
+                    gas_flux_list = []
+                    for el in meta_value:
+                        try:
+                            gas_flux_list.append({'value': MetadataProcessor._materialize(el[0]), 'unit': 'ml/min', 'gas_name': el[1]})
+                        except Exception as e:
+                            logging.warning(f"Error decoding gas_flux {el[1]} for {key_path}: {e}")
+                    if gas_flux_list:
+                        sche_ref[last_key] = gas_flux_list
+                        return True
+                except Exception as e:
+                    logging.warning(f"Error processing gas_flux for {key_path}: {e}")
+        except Exception as e:
+            logging.warning(f"Error while processing {key_path}: {e}")
+        return False
+
     @staticmethod
     def _process_schema_values(sche_ref, meta_ref, key_path, last_key):
         try:
             if last_key in meta_ref:
-                if sche_ref[last_key] in ["", -9999]:
-                    sche_ref[last_key] = meta_ref[last_key]
-                elif isinstance(sche_ref[last_key], dict) and 'value' in sche_ref[last_key]:
-                    if isinstance(meta_ref[last_key], float):
-                        sche_ref[last_key]['value'] = meta_ref[last_key]
-                    elif isinstance(meta_ref[last_key], str):
-                        sche_ref[last_key]['value'] = float(meta_ref[last_key])
-                    elif isinstance(meta_ref[last_key], np.ndarray):
-                        sche_ref[last_key]['value'] = meta_ref[last_key][-1]
-                    else:
-                        logging.warning(f"Unsupported type for 'value' key in {key_path}: {type(meta_ref[last_key])}")
-                elif isinstance(sche_ref[last_key], dict) and 'min_value' in sche_ref[last_key] and meta_ref[last_key].size > 0:
-                    try:
-                        MetadataProcessor._apply_arithmetic(sche_ref, meta_ref, last_key)
-                    except Exception as e:
-                        logging.warning(f"Error computing min or max for {key_path}: {e}")
-                elif last_key == 'gas_flux':
-                    try:
-                        gas_flux_list = [{'value': el[0], 'unit': 'ml/min', 'gas_name': el[1]} for el in meta_ref[last_key]]
-                        sche_ref[last_key] = gas_flux_list
-                    except Exception as e:
-                        logging.warning(f"Error processing gas_flux for {key_path}: {e}")
+                kind = MetadataProcessor.slot_kind(sche_ref[last_key], last_key)
+                MetadataProcessor.fill_slot(kind, sche_ref, last_key, meta_ref[last_key], key_path)
             else:
                 pass
         except Exception as e:
             logging.warning(f"Error while processing {key_path}: {e}")
 
     @staticmethod
-    def _apply_arithmetic(sche_ref, meta_ref, last_key):
-        minValue = np.nanmin(meta_ref[last_key])
-        maxValue = np.nanmax(meta_ref[last_key])
-        avgValue = (np.nanmin(meta_ref[last_key]) + np.nanmax(meta_ref[last_key])) / 2.
-    
-        arithmetic = [round(el, 3) if not np.isnan(el) else el for el in [minValue, maxValue, avgValue]]
-
-        sche_ref[last_key] = {'min_value': arithmetic[0], 'max_value': arithmetic[1], 'average_value': arithmetic[2]}
+    def _apply_arithmetic(sche_ref, last_key, data):
+        """
+        Replaces a statistics slot of the schema with the statistics of the metadata array, computed in one pass over its blocks.
+        'min_value' always comes with 'max_value' and 'average_value' (the mid-range); 'mean_value', 'std_value', 'count' and
+        'percentile_<q>' are computed only when the slot asks for them.
+        """
+        np = MetadataProcessor._numpy()
+        from streamingStatistics import StreamingStatistics
+
+        requested = [key for key in sche_ref[last_key] if MetadataProcessor._is_statistic(key)]
+        if 'min_value' in requested:
+            requested = ['min_value', 'max_value', 'average_value'] + [key for key in requested if key not in ['min_value', 'max_value', 'average_value']]
+
+        with_moments = any(key in ['mean_value', 'std_value', 'count'] for key in requested)
+        if isinstance(data, LazyDataset):
+            # Kept by the dataset, and only extended with the appended rows of a GrowingDataset; percentiles still need a pass
+            statistics = data.statistics(with_moments)
+        else:
+            statistics = StreamingStatistics.from_data(data, with_moments)
+
+        quantiles = [float(key[len(MetadataProcessor.percentilePrefix):]) for key in requested if key.startswith(MetadataProcessor.percentilePrefix)]
+        percentiles = dict(zip(quantiles, statistics.percentiles(data, quantiles))) if quantiles else {}
+
+        arithmetic = {}
+        for key in requested:
+            if key == 'count':
+                arithmetic[key] = statistics.count
+                continue
+            if key == 'min_value':
+                el = statistics.minimum
+            elif key == 'max_value':
+                el = statistics.maximum
+            elif key == 'average_value':
+                el = statistics.average
+            elif key == 'mean_value':
+                el = statistics.mean if statistics.count > 0 else np.nan
+            elif key == 'std_value':
+                el = statistics.std
+            else:
+                el = percentiles[float(key[len(MetadataProcessor.percentilePrefix):])]
+            arithmetic[key] = round(el, 3) if not np.isnan(el) else el
+
+        sche_ref[last_key] = arithmetic
 
     @staticmethod
     def validate_file_path(file_path, expected_extension):
@@ -0,0 +1,114 @@
+from collections.abc import Mapping
+
+class MetadataTree(Mapping):
+    """
+    Metadata of a NeXus file as a trie of its groups: each group is a dictionary of its members, and the datasets are
+    the leaves. NeXusReader fills it while it traverses the file, and the mapping looks the schema paths up in it
+    directly, so the paths are never joined into strings and split again.
+    It is a read-only mapping of dataset paths (tuples, or strings joined with '/') to values:
+        tree[('entry', 'title')], ('entry', 'title') in tree, tree.items() -> ((('entry', 'title'), value), ...)
+    """
+    def __init__(self, root=None, size=0):
+        self._root = root if root is not None else {}
+        self._size = size
+
+    @staticmethod
+    def _path(path):
+        return tuple(path.split('/')) if isinstance(path, str) else path
+
+    def set(self, path, value):
+        """
+        Adds a dataset, creating its groups.
+        Inputs: path (tuple)
+                value: dataset value or LazyDataset (anything but a dictionary)
+        """
+        node = self._root
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        if path[-1] not in node:
+            self._size += 1
+        node[path[-1]] = value
+
+    def with_values(self, values):
+        """
+        New tree with the given datasets added or replaced. Only the groups on their paths are copied, the rest of the
+        tree is shared, so the metadata of a file can be extended for one mapping without changing it for the others.
+        Inputs: values: path -> value (dictionary)
+        Output: tree (MetadataTree)
+        """
+        tree = MetadataTree(dict(self._root), self._size)
+        copied = {(): tree._root}
+        for path, value in values.items():
+            path = self._path(path)
+            node = tree._root
+            for i, key in enumerate(path[:-1]):
+                child = node.get(key)
+                if path[:i + 1] not in copied:
+                    child = dict(child) if isinstance(child, dict) else {}
+                    node[key] = child
+                    copied[path[:i + 1]] = child
+                node = child
+            if path[-1] not in node:
+                tree._size += 1
+            node[path[-1]] = value
+        return tree
+
+    def _node(self, path):
+        node = self._root
+        for key in path:
+            if not isinstance(node, dict):
+                return None, False
+            node = node.get(key, self)
+            if node is self:
+                return None, False
+        return node, True
+
+    def __getitem__(self, path):
+        node, found = self._node(self._path(path))
+        if not found or isinstance(node, dict):
+            raise KeyError(path)
+        return node
+
+    def __contains__(self, path):
+        node, found = self._node(self._path(path))
+        return found and not isinstance(node, dict)
+
+    def __iter__(self):
+        for path, value in self.items():
+            yield path
+
+    def __len__(self):
+        return self._size
+
+    def items(self):
+        """
+        Datasets in the order they were added, as (path, value) pairs; the path is a tuple.
+        """
+        stack = [((), iter(self._root.items()))]
+        while stack:
+            prefix, members = stack[-1]
+            for key, node in members:
+                if isinstance(node, dict):
+                    stack.append((prefix + (key,), iter(node.items())))
+                    break
+                yield prefix + (key,), node
+            else:
+                stack.pop()
+
+    def group(self, path):
+        """
+        Members of a group, None when the group does not exist.
+        Inputs: path (tuple or string)
+        Output: name -> subgroup (dictionary) or value (dictionary)
+        """
+        node, found = self._node(self._path(path))
+        return node if found and isinstance(node, dict) else None
+
+    def to_dict(self):
+        """
+        Flat dictionary keyed by the paths joined with '/', as NeXusReader returned the metadata before.
+        """
+        return {'/'.join(path): value for path, value in self.items()}
+
+    def __repr__(self):
+        return f"MetadataTree({len(self)} datasets)"
@@ -1,84 +1,463 @@
+import io
 import os
-import h5py
-import pandas as pd
-import numpy as np
+import re
 import zipfile
+import struct
 import logging
 import shutil
-from pathlib import Path
+import tempfile
+from conversionMetrics import ConversionMetrics
+from metadataTree import MetadataTree
+
+# h5py and numpy are imported by the functions that read NeXus files, so that the command line starts without them
+# when it only lists a zip archive, serves a document from the cache or reports an error.
+
+class ReadSelection:
+    """
+    Describes which parts of a NeXus file can be used by the mapping, so that the reader opens only those.
+    Inputs: paths: dataset paths of interest (iterable of tuples) ## [('entry', 'title'), ...]
+            name_patterns: regular expressions matched against dataset names found anywhere in the tree (iterable of strings)
+    """
+    def __init__(self, paths, name_patterns=()):
+        self.paths = {tuple(path) for path in paths}
+        self.prefixes = {path[:i] for path in self.paths for i in range(1, len(path))}
+        self.name_patterns = [re.compile(pattern) for pattern in name_patterns]
+
+    def wants_group(self, path):
+        # Datasets selected by name may live in any group, so every group has to be visited to find them.
+        return bool(self.name_patterns) or path in self.prefixes
+
+    def wants_dataset(self, path):
+        return path in self.paths or any(pattern.search(path[-1]) for pattern in self.name_patterns)
+
+    @staticmethod
+    def union(selections):
+        """
+        Selection of everything that any of the selections wants, e.g. for the schemas of a multi-schema conversion.
+        Inputs: selections (list of ReadSelection, None for everything)
+        Output: selection (ReadSelection), None when one of the selections is None
+        """
+        if any(selection is None for selection in selections):
+            return None
+        paths = [path for selection in selections for path in selection.paths]
+        patterns = dict.fromkeys(pattern.pattern for selection in selections for pattern in selection.name_patterns)
+        return ReadSelection(paths, patterns)
+
+    def wants(self, group, obj_class):
+        import h5py
+        path = tuple(group.split('/')) if isinstance(group, str) else group
+        if obj_class is h5py.Group:
+            return self.wants_group(path)
+        return self.wants_dataset(path)
+
+
+class LazyDataset:
+    """
+    Handle on a NeXus dataset that is read only when its value is placed into the document.
+    It supports slicing, so statistics can be computed block by block directly from the file.
+    The value, the last element and the statistics are kept once read, so that the documents of several schemas
+    mapped from the same metadata read each dataset once.
+    """
+    def __init__(self, dataset, group, metrics=None):
+        self.dataset = dataset
+        self.group = group
+        self.metrics = metrics
+        self._value = None
+        self._last = None
+        self._statistics = {}
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    @property
+    def ndim(self):
+        return self.dataset.ndim
+
+    @property
+    def size(self):
+        return self.dataset.size
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def chunks(self):
+        return self.dataset.chunks
+
+    def __getitem__(self, selection):
+        return self._read(selection)
+
+    def _read(self, selection):
+        data = self.dataset[selection]
+        if self.metrics is not None:
+            self.metrics.count_read(data)
+        return data
+
+    def read(self):
+        """
+        Reads the whole dataset, decoding scalars as NeXusReader.extract_metadata does.
+        Output: value (numpy array or string)
+        """
+        if self._value is None:
+            self._value = self._read_value()
+        return self._value
+
+    def _read_value(self):
+        import numpy as np
+        data = self._read(())
+        if isinstance(data, np.ndarray):
+            return data
+        return data.decode('utf-8')
+
+    def last(self):
+        """
+        Reads only the final element along the first axis (an HDF5 hyperslab selection).
+        Output: value (numpy scalar or array)
+        """
+        if self.dataset.ndim == 0:
+            return self.read()
+        if self._last is None:
+            if self.dataset.shape[0] == 0:
+                raise IndexError(f"Dataset {self.group} is empty")
+            self._last = self._read(self.dataset.shape[0] - 1)
+        return self._last
+
+    def statistics(self, with_moments=False):
+        """
+        Statistics of the dataset, computed in one pass over its blocks. Statistics with moments also serve the
+        requests without them.
+        Inputs: with_moments: also compute count, mean and standard deviation (boolean)
+        Output: statistics (StreamingStatistics)
+        """
+        from streamingStatistics import StreamingStatistics
+        statistics = self._statistics.get(True) or self._statistics.get(with_moments)
+        if statistics is None:
+            statistics = StreamingStatistics.from_data(self, with_moments)
+            self._statistics[with_moments] = statistics
+        return statistics
+
+    def __repr__(self):
+        return f"LazyDataset({self.group!r}, shape={self.shape}, dtype={self.dtype})"
+
+
+class GrowingDataset(LazyDataset):
+    """
+    LazyDataset of a NeXus file read in SWMR mode while another process appends to it along the first axis.
+    After refresh, only the rows appended since the previous read are read: the array, its last element and its
+    running statistics are extended instead of being read again.
+    """
+    def __init__(self, dataset, group, metrics=None):
+        super().__init__(dataset, group, metrics)
+        self._shape = dataset.shape
+        self._last_rows = None
+        self._statistics_rows = {}
+
+    def refresh(self):
+        """
+        Reloads the shape of the dataset from the file.
+        Output: True when the dataset grew since the previous refresh (boolean)
+        """
+        if self.dataset.file.swmr_mode:
+            self.dataset.refresh()
+        shape = self.dataset.shape
+        grew, self._shape = shape != self._shape, shape
+        return grew
+
+    def read(self):
+        import numpy as np
+        if self.dataset.ndim == 0:
+            return self._read_value()
+        rows = self.dataset.shape[0]
+        if self._value is None or self._value.shape[0] > rows or self._value.shape[1:] != self.dataset.shape[1:]:
+            self._value = self._read_value()
+        elif self._value.shape[0] < rows:
+            self._value = np.concatenate([self._value, self._read(slice(self._value.shape[0], rows))])
+        return self._value
+
+    def last(self):
+        if self.dataset.ndim > 0 and self._last_rows != self.dataset.shape[0]:
+            self._last, self._last_rows = None, self.dataset.shape[0]
+        return super().last()
+
+    def statistics(self, with_moments=False):
+        """
+        Running statistics of the dataset, updated with the rows appended since they were last requested.
+        Inputs: with_moments: also compute count, mean and standard deviation (boolean)
+        Output: statistics (StreamingStatistics)
+        """
+        from streamingStatistics import StreamingStatistics
+        if self.dataset.ndim == 0:
+            return StreamingStatistics.from_data(self, with_moments)
+        statistics, rows = self._statistics.get(with_moments), self._statistics_rows.get(with_moments, 0)
+        if statistics is None or rows > self.dataset.shape[0]:
+            statistics, rows = StreamingStatistics(with_moments), 0
+        for block in StreamingStatistics.iter_blocks(self, start=rows):
+            statistics.update(block)
+        self._statistics[with_moments] = statistics
+        self._statistics_rows[with_moments] = self.dataset.shape[0]
+        return statistics
+
+
+class StoredZipMember(io.RawIOBase):
+    """
+    Seekable read-only view of an uncompressed (ZIP_STORED) zip member, read in place from the archive.
+    Unlike zipfile.ZipExtFile, seeking backwards does not re-read the member from its start.
+    """
+    def __init__(self, zip_path, member):
+        super().__init__()
+        self._file = open(zip_path, 'rb')
+        self._file.seek(member.header_offset)
+        local_header = self._file.read(30)
+        if local_header[:4] != b'PK\x03\x04':
+            self._file.close()
+            raise zipfile.BadZipFile(f"Bad local file header for {member.filename}")
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        self._start = member.header_offset + 30 + name_length + extra_length
+        self._size = member.file_size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        self._position = max(0, self._position)
+        return self._position
+
+    def readinto(self, buffer):
+        length = max(0, min(len(buffer), self._size - self._position))
+        if length == 0:
+            return 0
+        self._file.seek(self._start + self._position)
+        n = self._file.readinto(memoryview(buffer)[:length])
+        self._position += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
 
 class NeXusReader:
-    def __init__(self, file_path):
+
+    # Compressed zip members up to this size are decompressed into memory, larger ones into a single temporary file
+    spool_max_bytes = 256 * 1024 * 1024
+
+    def __init__(self, file_path, selection=None, lazy=False, metrics=None, swmr=False):
         self.file_path = file_path
-        self.all_metadata = {}
+        self.selection = selection
+        # A file still being written is opened in SWMR read mode, with GrowingDataset handles (lazy reading)
+        self.swmr = swmr
+        self.lazy = lazy or swmr
+        self.metrics = metrics
+        self.all_metadata = MetadataTree()
         self.all_metadata_zip = {}
-        self.temp_folder = os.path.splitext(self.file_path)[0]
+        self._open_files = []
+
+    @property
+    def file_name(self):
+        """
+        Name of the NeXus file without its extension; the file_path may also be a binary file object, e.g. io.BytesIO
+        """
+        name = self.file_path if isinstance(self.file_path, (str, os.PathLike)) else getattr(self.file_path, 'name', 'nexus')
+        return os.path.basename(os.path.splitext(name)[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the NeXus files (and the zip members they are read from) kept open for lazy reading.
+        """
+        for f in reversed(self._open_files):
+            try:
+                f.close()
+            except Exception as e:
+                logging.info(f"Error closing NeXus file: {e}")
+        self._open_files = []
 
     def get_file_contain(self):
+        """
+        Reads the metadata of a NeXus file, or of every NeXus file of a zip archive. Zip members are read in place
+        and fully, one after another, so that only the member being read exists outside the archive.
+        Use iter_file_contain to process large archives one file at a time.
+        Output: metadata (MetadataTree, or dictionary of MetadataTree by file name for a zip) and file type ("_nxs" or "_zip")
+        """
         if zipfile.is_zipfile(self.file_path):
-            self._process_zip_file()
-            for nxs_file in Path(self.temp_folder).rglob("*.nxs"):
-                if "__MACOSX" not in str(nxs_file):
-                    self.file_path = nxs_file
-                    file_name = os.path.basename(os.path.splitext(nxs_file)[0])
-                    logging.info(f"Processing extracted file: {file_name}")
-                    self.all_metadata_zip[file_name] = self._read_nxs_file()
-                    
-            logging.info(f"Cleaning up temporary folder: {self.temp_folder}")
             try:
-                shutil.rmtree(self.temp_folder)
+                for file_name, metadata in self.iter_file_contain(lazy=False):
+                    self.all_metadata_zip[file_name] = metadata
+            except FileNotFoundError:
+                #logging.error("Error: Zip file not found.")
+                logging.info("Error: Zip file not found.")
             except Exception as e:
-                #logging.error(f"Error deleting temporary folder: {e}")
-                logging.info(f"Error deleting temporary folder: {e}")
-                
+                logging.warning(f"Error processing the zip file: {e}")
+
             return self.all_metadata_zip, "_zip"
             
         else:
             logging.info(f"Processing NeXus file: {self.file_path}")
+            if self.metrics is not None:
+                self.metrics.start_file(self.file_name)
             return self._read_nxs_file(), "_nxs"    
-            
-    def _read_nxs_file(self):
+
+    def iter_file_contain(self, member_names=None, lazy=None):
+        """
+        Yields the metadata of the NeXus file, or of the NeXus files of a zip archive, one file at a time. The files
+        of an item are closed when the next item is requested, so the metadata of an item (and its lazy datasets)
+        must be used before moving on; memory is then bounded by the largest single file.
+        Inputs: member_names: names of the zip members to read, in this order; all NeXus members when None (list of strings)
+                lazy: overrides the lazy mode of the reader (boolean)
+        Output: (file name, metadata or error message) pairs (generator)
+        """
+        if not zipfile.is_zipfile(self.file_path):
+            logging.info(f"Processing NeXus file: {self.file_path}")
+            file_name = self.file_name
+            if self.metrics is not None:
+                self.metrics.start_file(file_name)
+            try:
+                yield file_name, self._read_nxs_file(lazy=lazy)
+            finally:
+                self.close()
+            return
+
+        with zipfile.ZipFile(self.file_path, 'r') as zip_ref:
+            if member_names is None:
+                members = self.list_nxs_members(zip_ref)
+            else:
+                members = [zip_ref.getinfo(member_name) for member_name in member_names]
+            for member in members:
+                file_name = os.path.basename(os.path.splitext(member.filename)[0])
+                logging.info(f"Processing zipped file: {file_name}")
+                if self.metrics is not None:
+                    self.metrics.start_file(file_name)
+                try:
+                    with ConversionMetrics.measure(self.metrics, 'open'):
+                        source = self._open_member(zip_ref, member)
+                    metadata = self._read_nxs_file(source, lazy=lazy)
+                except Exception as e:
+                    logging.info(f"Error reading Nexus file: {e}")
+                    metadata = f"Error reading Nexus file: {e}"
+                try:
+                    yield file_name, metadata
+                finally:
+                    self.close()
+
+    @staticmethod
+    def list_nxs_members(zip_ref):
+        """
+        Lists the NeXus files of a zip archive, leaving out the macOS resource forks.
+        Inputs: zip_ref (zipfile.ZipFile)
+        Output: members (list of zipfile.ZipInfo)
+        """
+        return [member for member in zip_ref.infolist()
+                if not member.is_dir() and member.filename.endswith(".nxs") and "__MACOSX" not in member.filename]
+
+    def _open_member(self, zip_ref, member):
+        """
+        Opens a zip member as a seekable file object for h5py without extracting the archive.
+        Stored members of an archive on disk are read in place; the others are copied into a spooled buffer, which only
+        lives while the member is processed.
+        """
+        if member.compress_type == zipfile.ZIP_STORED and isinstance(self.file_path, (str, os.PathLike)):
+            return StoredZipMember(zip_ref.filename, member)
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_bytes)
+        try:
+            with zip_ref.open(member) as member_file:
+                shutil.copyfileobj(member_file, spool, 1024 * 1024)
+            spool.seek(0)
+        except Exception:
+            spool.close()
+            raise
+        return spool
+
+    def _read_nxs_file(self, source=None, lazy=None):
+        """
+        Reads the metadata of one NeXus file.
+        Inputs: source: file object of a zip member, the file_path is read when None
+                lazy: overrides the lazy mode of the reader (boolean)
+        Output: metadata (MetadataTree) or error message (string)
+        """
+        import h5py
+        source = self.file_path if source is None else source
+        lazy = self.lazy if lazy is None else lazy
+        if not isinstance(source, (str, os.PathLike)) and lazy:
+            self._open_files.append(source)
         try:
-            with h5py.File(self.file_path, 'r') as f:
-                self.all_metadata = self.extract_metadata(f)
+            with ConversionMetrics.measure(self.metrics, 'read'):
+                if lazy:
+                    f = h5py.File(source, 'r', libver='latest', swmr=True) if self.swmr else h5py.File(source, 'r')
+                    self._open_files.append(f)
+                    self.all_metadata = self.extract_metadata(f, selection=self.selection, lazy=True, metrics=self.metrics, swmr=self.swmr)
+                else:
+                    with h5py.File(source, 'r') as f:
+                        self.all_metadata = self.extract_metadata(f, selection=self.selection, metrics=self.metrics)
         except Exception as e:
             #raise ValueError(f"Error reading Nexus file: {e}")
             logging.info(f"Error reading Nexus file: {e}")
             return f"Error reading Nexus file: {e}"
+        finally:
+            if not isinstance(source, (str, os.PathLike)) and not lazy:
+                source.close()
         return self.all_metadata
-
-    def _process_zip_file(self):
-        try:
-            os.makedirs(self.temp_folder, exist_ok = True)
-            
-            with zipfile.ZipFile(self.file_path, 'r') as zip_ref:
-                zip_ref.extractall(self.temp_folder)
-        except FileNotFoundError:
-            #logging.error("Error: Zip file not found.")
-            logging.info("Error: Zip file not found.")
-        except Exception as e:
-            logging.warning(f"Error processing the zip file: {e}")
-            
         
     @staticmethod
-    def extract_metadata(obj, group=''):
+    def extract_metadata(obj, group='', selection=None, lazy=False, metrics=None, swmr=False, tree=None):
         """
-        Recursive function to travel all over the nexus file tree and extract all the metadata as a dictionary.
+        Recursive function to travel all over the nexus file tree and extract all the metadata into a path trie.
         Inputs: obj: h5py (object)
-               group: path to a directory (string)
-        Output: metadata (dictionary)
+               group: path to a directory (string or tuple)
+               selection: groups and datasets to read, everything is read when None (ReadSelection)
+               lazy: return LazyDataset handles instead of reading the datasets (boolean)
+               metrics: counts the datasets read (ConversionMetrics)
+               swmr: return GrowingDataset handles, for a file opened in SWMR mode (boolean)
+               tree: the metadata is added to this tree, a new one when None (MetadataTree)
+        Output: metadata (MetadataTree)
         """
-        metadata = {}
+        import h5py
+        import numpy as np
+        tree = MetadataTree() if tree is None else tree
+        path = tuple(group.split('/')) if isinstance(group, str) and group else tuple(group)
         if isinstance(obj, h5py.Group):
             for key in obj.keys():
-                full_directory = f"{group}/{key.strip()}" if group else key
-                metadata.update(NeXusReader.extract_metadata(obj[key], full_directory))
+                member_path = path + (key.strip(),) if path else (key,)
+                if selection is not None and not selection.wants(member_path, obj.get(key, getclass=True)):
+                    continue
+                NeXusReader.extract_metadata(obj[key], member_path, selection, lazy, metrics, swmr, tree)
         elif isinstance(obj, h5py.Dataset):
+            name = '/'.join(path)
+            if swmr:
+                tree.set(path, GrowingDataset(obj, name, metrics))
+                return tree
+            if lazy:
+                tree.set(path, LazyDataset(obj, name, metrics))
+                return tree
             try:
-                if isinstance(obj[()], np.ndarray):
-                    metadata[group] = obj[()]
+                data = obj[()]
+                if metrics is not None:
+                    metrics.count_read(data)
+                if isinstance(data, np.ndarray):
+                    tree.set(path, data)
                 else:
-                    metadata[group] = obj[()].decode('utf-8')
+                    tree.set(path, data.decode('utf-8'))
             except Exception as e:
-                logging.warning(f"Error decoding dataset {group}: {e}")
-        return metadata
\ No newline at end of file
+                logging.warning(f"Error decoding dataset {name}: {e}")
+        return tree
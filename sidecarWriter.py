@@ -0,0 +1,88 @@
+import io
+import os
+import hashlib
+import logging
+
+class SidecarWriter:
+    """
+    Writes the arrays placed into plain schema slots ("") to .npy files next to the document, instead of inlining them
+    in the JSON. The array is copied block by block from HDF5 into the file, and the slot receives a reference:
+        {"sidecar": "<document>.arrays/entry.data.current.npy", "format": "npy", "shape": [...], "dtype": "<f8", "sha256": "..."}
+    The path is relative to the directory of the document and the digest is that of the .npy file, which can be
+    memory-mapped with numpy.load(path, mmap_mode='r').
+    Inputs: min_bytes: arrays of at least this size are written to sidecars, smaller ones stay in the document (integer)
+            directory: directory of the .npy files, set by for_document (string)
+            reference_base: directory the references are relative to, set by for_document (string)
+    """
+
+    # Only numeric and boolean arrays are written; strings and objects stay in the document
+    dtype_kinds = 'biufc'
+
+    def __init__(self, min_bytes=64 * 1024, directory=None, reference_base=None):
+        self.min_bytes = min_bytes
+        self.directory = directory
+        self.reference_base = reference_base
+
+    def for_document(self, document_path):
+        """
+        Writer of the sidecars of a document (or of the documents of an output zip): <document>.arrays/ next to it.
+        """
+        return SidecarWriter(self.min_bytes, os.path.splitext(document_path)[0] + '.arrays',
+                             os.path.dirname(os.path.abspath(document_path)))
+
+    def for_file(self, file_name):
+        """
+        Writer of the sidecars of one NeXus file of a zip archive, in a directory of its own.
+        """
+        return SidecarWriter(self.min_bytes, os.path.join(self.directory, file_name), self.reference_base)
+
+    def wants(self, value, coercion=None):
+        """
+        Whether a value placed into a plain slot goes to a sidecar.
+        Inputs: value: metadata value, possibly a LazyDataset (object)
+                coercion: coercion of the slot, see MappingRules.coerce (dictionary or None)
+        Output: boolean
+        """
+        dtype = getattr(value, 'dtype', None)
+        if dtype is None or getattr(value, 'ndim', 0) == 0 or dtype.kind not in self.dtype_kinds:
+            return False
+        if coercion is not None and coercion.get('type') == 'str':
+            return False
+        return value.size * dtype.itemsize >= self.min_bytes
+
+    def write(self, path, data, coercion=None):
+        """
+        Writes an array to <directory>/<slot path joined by dots>.npy, applying the coercion of the slot block by block.
+        Inputs: path: path of the slot in the document (tuple)
+                data: numpy array or LazyDataset
+                coercion: see MappingRules.coerce (dictionary or None)
+        Output: reference placed into the slot (dictionary)
+        """
+        import numpy as np
+        from numpy.lib import format as npy_format
+        from mappingRules import MappingRules
+        from streamingStatistics import StreamingStatistics
+
+        dtype = data.dtype if coercion is None else MappingRules.coerce(np.zeros(0, data.dtype), coercion).dtype
+        header = io.BytesIO()
+        npy_format.write_array_header_1_0(header, {'descr': npy_format.dtype_to_descr(dtype), 'fortran_order': False,
+                                                   'shape': tuple(data.shape)})
+        os.makedirs(self.directory, exist_ok=True)
+        file_path = os.path.join(self.directory, '.'.join(path) + '.npy')
+        sha = hashlib.sha256(header.getvalue())
+        with open(file_path, 'wb') as f:
+            f.write(header.getvalue())
+            for block in StreamingStatistics.iter_blocks(data):
+                if coercion is not None:
+                    block = MappingRules.coerce(block, coercion)
+                block = memoryview(np.ascontiguousarray(block, dtype=dtype)).cast('B')
+                sha.update(block)
+                f.write(block)
+        logging.info(f"{file_path} has been created successfully!")
+        return {
+            'sidecar': os.path.relpath(file_path, self.reference_base).replace(os.sep, '/'),
+            'format': 'npy',
+            'shape': list(data.shape),
+            'dtype': dtype.str,
+            'sha256': sha.hexdigest()
+        }
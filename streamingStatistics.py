@@ -0,0 +1,145 @@
+import numpy as np
+
+class StreamingStatistics:
+    """
+    NaN-aware running statistics of an array, updated block by block so that the array is never held in memory at once.
+    The data can be a numpy array or an h5py dataset, both are only sliced along the first axis.
+    """
+
+    # Upper bound for the size of a block read at once
+    block_bytes = 4 * 1024 * 1024
+
+    # Number of histogram bins used for percentiles of arrays larger than one block
+    percentile_bins = 65536
+
+    def __init__(self, with_moments=False):
+        self.with_moments = with_moments
+        self.count = 0
+        self.minimum = np.nan
+        self.maximum = np.nan
+        self.mean = 0.
+        self.m2 = 0.
+
+    @staticmethod
+    def iter_blocks(data, block_bytes=None, start=0):
+        """
+        Yields consecutive blocks of data along the first axis, aligned to the HDF5 chunks when the data is chunked.
+        Inputs: data: numpy array or h5py dataset
+                block_bytes: upper bound for the size of a block (integer)
+                start: first row, e.g. the first row appended to a growing dataset (integer)
+        Output: blocks (generator of numpy arrays)
+        """
+        block_bytes = block_bytes or StreamingStatistics.block_bytes
+        shape = data.shape
+        if len(shape) == 0:
+            yield np.asarray(data[()])
+            return
+        if shape[0] <= start:
+            return
+
+        row_bytes = max(1, int(np.prod(shape[1:], dtype=np.int64)) * data.dtype.itemsize)
+        rows = max(1, block_bytes // row_bytes)
+        chunks = getattr(data, 'chunks', None)
+        if chunks:
+            rows = max(chunks[0], rows - rows % chunks[0])
+
+        for block_start in range(start, shape[0], rows):
+            yield np.asarray(data[block_start:block_start + rows])
+
+    def update(self, block):
+        """
+        Adds a block of values to the running statistics.
+        Inputs: block (numpy array)
+        """
+        if block.size == 0:
+            return
+        flat = block.reshape(-1)
+        self.minimum = np.fmin(self.minimum, np.fmin.reduce(flat))
+        self.maximum = np.fmax(self.maximum, np.fmax.reduce(flat))
+
+        if not self.with_moments:
+            return
+        if np.issubdtype(flat.dtype, np.inexact):
+            flat = flat[~np.isnan(flat)]
+        count = flat.size
+        if count == 0:
+            return
+        mean = flat.mean(dtype=np.float64)
+        m2 = np.square(flat - mean, dtype=np.float64).sum()
+        self._merge_moments(count, mean, m2)
+
+    def merge(self, other):
+        """
+        Combines the statistics of another instance into this one (parallel algorithm of Chan et al.).
+        Inputs: other (StreamingStatistics)
+        """
+        self.minimum = np.fmin(self.minimum, other.minimum)
+        self.maximum = np.fmax(self.maximum, other.maximum)
+        if self.with_moments and other.count > 0:
+            self._merge_moments(other.count, other.mean, other.m2)
+
+    def _merge_moments(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    @property
+    def average(self):
+        # Mid-range of the values, as reported in the 'average_value' field of the documents
+        return (self.minimum + self.maximum) / 2.
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count > 0 else np.nan
+
+    @classmethod
+    def from_data(cls, data, with_moments=False, block_bytes=None):
+        """
+        Computes the statistics of a whole array in one pass over its blocks.
+        Inputs: data: numpy array or h5py dataset
+                with_moments: also compute count, mean and standard deviation (boolean)
+        Output: statistics (StreamingStatistics)
+        """
+        statistics = cls(with_moments)
+        for block in cls.iter_blocks(data, block_bytes):
+            statistics.update(block)
+        return statistics
+
+    def percentiles(self, data, quantiles, block_bytes=None):
+        """
+        Percentiles of the non-NaN values of data. They are exact when data fits into one block, otherwise they are
+        interpolated from a histogram over [minimum, maximum] built in a second pass, with an error below one bin width.
+        Inputs: data: numpy array or h5py dataset, already passed to update
+                quantiles: percentiles to compute, between 0 and 100 (list of floats)
+        Output: percentiles (list of floats)
+        """
+        block_bytes = block_bytes or self.block_bytes
+        if data.size * data.dtype.itemsize <= block_bytes:
+            values = np.asarray(data[()], dtype=np.float64)
+            return [float(el) for el in np.nanpercentile(values, quantiles)]
+        if np.isnan(self.minimum):
+            return [np.nan for _ in quantiles]
+        if self.minimum == self.maximum:
+            return [float(self.minimum) for _ in quantiles]
+
+        value_range = (float(self.minimum), float(self.maximum))
+        edges = np.linspace(value_range[0], value_range[1], self.percentile_bins + 1)
+        counts = np.zeros(self.percentile_bins, dtype=np.int64)
+        for block in self.iter_blocks(data, block_bytes):
+            if np.issubdtype(block.dtype, np.inexact):
+                block = block[~np.isnan(block)]
+            counts += np.histogram(block, bins=self.percentile_bins, range=value_range)[0]
+
+        cumulative = np.cumsum(counts)
+        total = cumulative[-1]
+        result = []
+        for q in quantiles:
+            rank = q / 100. * (total - 1)
+            index = int(np.searchsorted(cumulative, rank, side='right'))
+            index = min(index, self.percentile_bins - 1)
+            below = cumulative[index - 1] if index > 0 else 0
+            fraction = (rank - below) / counts[index] if counts[index] > 0 else 0.
+            result.append(float(edges[index] + fraction * (edges[index + 1] - edges[index])))
+        return result
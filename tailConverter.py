@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+from neXusReader import NeXusReader, GrowingDataset
+from jsonOutputter import JsonOutputter
+from conversionMetrics import ConversionMetrics
+from batchConverter import BatchConverter
+
+class TailConverter:
+    """
+    Converts a NeXus file while it is still being written, e.g. during a measurement. The file is opened in SWMR read
+    mode and the document is written again at every interval in which a dataset grew. Only the appended rows are read:
+    arrays, 'value' fields and min/max/average are extended from the previous document instead of being read again.
+    The HDF5 tree of a file written in SWMR mode cannot change, so it is traversed once.
+    Inputs: plan: compiled JSON file schema (MappingPlan)
+            nexus_path: path to the NeXus file (string)
+            document_path: path to the JSON document (string)
+            full_read: read every dataset instead of only those the schema can use (boolean)
+            compact: write the document without indentation and spaces (boolean)
+            metrics: records the stages of the conversion (ConversionMetrics)
+            catalogue: index the document is added to, replaced at every update (MetadataCatalogue)
+    """
+    def __init__(self, plan, nexus_path, document_path, full_read=False, compact=False, metrics=None, catalogue=None):
+        self.plan = plan
+        self.nexus_path = nexus_path
+        self.document_path = document_path
+        self.full_read = full_read
+        self.compact = compact
+        self.metrics = metrics
+        self.catalogue = catalogue
+        self.reader = None
+        self.metadata = None
+        self.datasets = []
+        # Why the file could not be opened the last time, see open
+        self.open_error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Opens the NeXus file in SWMR read mode.
+        Output: True when the file could be read (boolean)
+        """
+        selection = None if self.full_read else self.plan.read_selection()
+        reader = NeXusReader(self.nexus_path, selection=selection, metrics=self.metrics, swmr=True)
+        metadata, file_type = reader.get_file_contain()
+        if isinstance(metadata, str):
+            # Not created yet, or not yet switched to SWMR mode by the writer
+            reader.close()
+            self.open_error = metadata
+            return False
+        self.reader = reader
+        self.metadata = metadata
+        self.datasets = [value for value in self.metadata.values() if isinstance(value, GrowingDataset)]
+        return True
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def refresh(self):
+        """
+        Reloads the shapes of the datasets written since the previous refresh.
+        Output: True when any dataset grew (boolean)
+        """
+        with ConversionMetrics.measure(self.metrics, 'refresh'):
+            # Every dataset is refreshed, not only until the first one that grew
+            return sum(dataset.refresh() for dataset in self.datasets) > 0
+
+    def write(self):
+        """
+        Maps the current metadata and replaces the document. It is written under a temporary name and renamed, so
+        that readers of the document never see it half written.
+        """
+        document = self.plan.create_document(self.metadata, self.metrics)
+        with ConversionMetrics.measure(self.metrics, 'serialize'):
+            json_text = JsonOutputter.dumps(document, self.compact)
+        with ConversionMetrics.measure(self.metrics, 'write'):
+            temp_path = self.document_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(json_text)
+            os.replace(temp_path, self.document_path)
+        if self.catalogue is not None:
+            BatchConverter.catalogue_document(self.catalogue, self.document_path, os.path.basename(self.document_path),
+                                              self.nexus_path, self.metrics, document)
+            self.catalogue.commit()
+
+    def run(self, interval, idle_timeout=None):
+        """
+        Writes the document, then updates it every interval seconds while the file grows, until the file has not grown
+        for idle_timeout seconds or until interrupted. A file that cannot be opened in SWMR mode within idle_timeout
+        seconds raises a ValueError with the reason given by the reader.
+        Inputs: interval: seconds between two refreshes (number)
+                idle_timeout: seconds without growth after which the file is considered finished, never when None (number)
+        """
+        try:
+            waiting_since = time.monotonic()
+            while not self.open():
+                if idle_timeout is not None and time.monotonic() - waiting_since >= idle_timeout:
+                    raise ValueError(f"{self.nexus_path} could not be opened in SWMR mode for {idle_timeout} s: {self.open_error}")
+                logging.info(f"Waiting for {self.nexus_path} to be readable in SWMR mode")
+                time.sleep(interval)
+            self.write()
+            logging.info(f"Following {self.nexus_path} every {interval} s")
+            last_growth = time.monotonic()
+            while idle_timeout is None or time.monotonic() - last_growth < idle_timeout:
+                time.sleep(interval)
+                if self.refresh():
+                    self.write()
+                    last_growth = time.monotonic()
+                    logging.info(f"{self.document_path} has been updated")
+            logging.info(f"{self.nexus_path} has not grown for {idle_timeout} s, stopped following it")
+        except KeyboardInterrupt:
+            logging.info(f"Stopped following {self.nexus_path}")
+        finally:
+            self.close()
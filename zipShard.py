@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import zipfile
+from jsonOutputter import ZipStreamWriter
+
+class ZipShard:
+    """
+    One of N shards of the NeXus files of a zip archive, so that a large archive can be converted on several nodes that
+    share only a filesystem. The partition is deterministic and needs no coordination: every node lists the archive and
+    keeps its own members, either by a hash of the member name or by contiguous ranges of the sorted names.
+    Each node writes a partial output zip and, once it is complete, an index next to it (<partial zip>.shard.json);
+    merge combines the partial zips into the final archive after checking that every member is in exactly one shard.
+    Inputs: number: number of the shard, from 1 to count (integer)
+            count: number of shards (integer)
+            by: 'hash' or 'name' (string)
+    """
+
+    index_version = 1
+    methods = ('hash', 'name')
+
+    def __init__(self, number, count, by='hash'):
+        if count < 1 or not 1 <= number <= count:
+            raise ValueError(f"Shard {number}/{count} does not exist, shards are numbered from 1 to {count}")
+        if by not in ZipShard.methods:
+            raise ValueError(f"Unknown shard partition {by}, expected one of {', '.join(ZipShard.methods)}")
+        self.number = number
+        self.count = count
+        self.by = by
+
+    @staticmethod
+    def parse(spec, by='hash'):
+        """
+        Reads a shard given as 'i/N', e.g. '2/8'.
+        Inputs: spec (string)
+                by: 'hash' or 'name' (string)
+        Output: shard (ZipShard)
+        """
+        try:
+            number, count = (int(part) for part in spec.split('/'))
+        except ValueError:
+            raise ValueError(f"Invalid shard {spec}, expected i/N, e.g. 2/8")
+        return ZipShard(number, count, by)
+
+    @staticmethod
+    def index_path(zip_file_path):
+        return os.path.splitext(zip_file_path)[0] + '.shard.json'
+
+    @staticmethod
+    def archive_digest(members):
+        """
+        Digest of the NeXus members of an archive (names, CRC-32 and sizes), which identifies the archive the shards
+        were taken from without reading it.
+        Inputs: members (list of zipfile.ZipInfo)
+        Output: digest (string)
+        """
+        sha = hashlib.sha256()
+        for member in members:
+            sha.update(f"{member.filename}\0{member.CRC}\0{member.file_size}\n".encode())
+        return sha.hexdigest()
+
+    def shard_of(self, member_name, rank, total):
+        """
+        Shard of a member, from 1 to count.
+        Inputs: member_name (string)
+                rank: position of the member among the sorted member names (integer)
+                total: number of members (integer)
+        Output: shard number (integer)
+        """
+        if self.by == 'name':
+            return rank * self.count // total + 1
+        digest = hashlib.sha256(member_name.encode()).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count + 1
+
+    def select(self, members):
+        """
+        Members of the archive that belong to this shard, in archive order.
+        Inputs: members: NeXus members of the archive, in archive order (list of zipfile.ZipInfo)
+        Output: members (list of zipfile.ZipInfo)
+        """
+        ranks = {name: rank for rank, name in enumerate(sorted(member.filename for member in members))}
+        return [member for member in members if self.shard_of(member.filename, ranks[member.filename], len(members)) == self.number]
+
+    def index(self, members, selected):
+        """
+        Index of the shard, without the output and the plan, see write_index.
+        Inputs: members: NeXus members of the archive (list of zipfile.ZipInfo)
+                selected: members of the shard (list of zipfile.ZipInfo)
+        Output: index (dictionary)
+        """
+        positions = {member.filename: position for position, member in enumerate(members)}
+        return {'version': self.index_version, 'shard': self.number, 'shards': self.count, 'by': self.by,
+                'archive_digest': ZipShard.archive_digest(members), 'archive_members': len(members),
+                'members': [[positions[member.filename], member.filename] for member in selected]}
+
+    @staticmethod
+    def write_index(zip_file_path, index, plan_digest, document_name):
+        """
+        Writes the index of a complete partial zip next to it, under a temporary name that is then renamed, so that
+        the index only exists for a partial zip that has been fully written.
+        Inputs: zip_file_path: path to the partial zip (string)
+                index: see index (dictionary)
+                plan_digest: digest of the schema and rules the documents were mapped with (string)
+                document_name: name of the document of a member in the zip, see BatchConverter.document_name (function)
+        """
+        index = dict(index, output=os.path.basename(zip_file_path), plan_digest=plan_digest,
+                     members=[[position, member_name, document_name(member_name)] for position, member_name in index['members']])
+        index_path = ZipShard.index_path(zip_file_path)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f, indent=4)
+            os.replace(temp_path, index_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        logging.info(f"Shard {index['shard']}/{index['shards']}: {len(index['members'])} of {index['archive_members']} files, indexed in {index_path}")
+
+    @staticmethod
+    def load_index(zip_file_path):
+        """
+        Reads the index of a partial zip.
+        Inputs: zip_file_path: path to the partial zip (string)
+        Output: index (dictionary)
+        """
+        index_path = ZipShard.index_path(zip_file_path)
+        if not os.path.exists(index_path):
+            raise ValueError(f"{zip_file_path} has no index {index_path}, its shard has not finished")
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') != ZipShard.index_version:
+            raise ValueError(f"{index_path} has version {index.get('version')}, expected {ZipShard.index_version}")
+        return index
+
+    @staticmethod
+    def verify(zip_file_paths):
+        """
+        Checks that the partial zips are the shards of one conversion: same archive, schema, rules and partition, every
+        shard present once and complete, and every member of the archive in exactly one shard.
+        Inputs: zip_file_paths: paths to the partial zips (list of strings)
+        Output: documents to merge, in archive order (list of (path to the partial zip, document name))
+        """
+        indexes = [ZipShard.load_index(zip_file_path) for zip_file_path in zip_file_paths]
+        if not indexes:
+            raise ValueError("No shards to merge")
+        first = indexes[0]
+        for zip_file_path, index in zip(zip_file_paths, indexes):
+            for key in ['shards', 'by', 'archive_digest', 'archive_members', 'plan_digest']:
+                if index[key] != first[key]:
+                    raise ValueError(f"{zip_file_path} does not belong to the same conversion as {zip_file_paths[0]}: different {key}")
+
+        numbers = sorted(index['shard'] for index in indexes)
+        missing = sorted(set(range(1, first['shards'] + 1)) - set(numbers))
+        repeated = sorted({number for number in numbers if numbers.count(number) > 1})
+        if missing or repeated:
+            raise ValueError(f"Shards of {first['shards']}: missing {missing}, given more than once {repeated}")
+
+        documents = {}
+        for zip_file_path, index in zip(zip_file_paths, indexes):
+            expected = [document_name for position, member_name, document_name in index['members']]
+            with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+                written = zip_ref.namelist()
+            if sorted(written) != sorted(expected):
+                raise ValueError(f"{zip_file_path} does not hold the {len(expected)} documents of its index")
+            for position, member_name, document_name in index['members']:
+                if position in documents:
+                    raise ValueError(f"{member_name} is in more than one shard")
+                documents[position] = (zip_file_path, document_name)
+
+        if sorted(documents) != list(range(first['archive_members'])):
+            raise ValueError(f"The shards hold {len(documents)} of the {first['archive_members']} files of the archive")
+        return [documents[position] for position in sorted(documents)]
+
+    @staticmethod
+    def merge(zip_file_paths, merged_zip_path, compression=zipfile.ZIP_DEFLATED, compresslevel=None):
+        """
+        Combines the partial zips of the shards into one zip, in the order of the original archive, after verifying them.
+        Inputs: zip_file_paths: paths to the partial zips (list of strings)
+                merged_zip_path: path to the output zip file (string)
+                compression: zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+                compresslevel: zlib compression level 0-9, the default level when None (integer)
+        Output: number of documents (integer)
+        """
+        documents = ZipShard.verify(zip_file_paths)
+        zip_refs = {}
+        try:
+            with ZipStreamWriter(merged_zip_path, compression, compresslevel) as writer:
+                for zip_file_path, document_name in documents:
+                    if zip_file_path not in zip_refs:
+                        zip_refs[zip_file_path] = zipfile.ZipFile(zip_file_path, 'r')
+                    writer.write(document_name, zip_refs[zip_file_path].read(document_name))
+        finally:
+            for zip_ref in zip_refs.values():
+                zip_ref.close()
+        return len(documents)